@@ -1,62 +1,232 @@
 """
 This file wraps all operations for the topic finder pipeline.
 """
+import asyncio
+import os
+import sys
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+import analytics
+import corpus_dataset
+import knowledge_base
+import output_dataset
 import preprocessing_utils as utils
-from topicfinder import TopicFinder
+import service
+from preprocessing_cache import PreprocessingCache
+from topicpredictor import TopicPredictor
+from topicfinder import KeywordIdf, matrix_to_lists, matrix_to_values
 import spacy
 
-CORPUS_PATH = "C:/Users/karkl/Desktop/NCC/datasets/legifrance.parquet"
+CORPUS_PATH = "C:/Users/karkl/Desktop/NCC/datasets/legifrance"
 KEYWORDS_TOPICS_PATH = "C:/Users/karkl/Desktop/NCC/datasets/topic_knownledge.xlsx"
+KNOWLEDGE_BASE_PATH = "C:/Users/karkl/Desktop/NCC/datasets/topic_knownledge.pickle"
+PREPROCESSING_CACHE_PATH = "C:/Users/karkl/Desktop/NCC/datasets/preprocessing_cache.sqlite"
+OUTPUT_PATH = "C:/Users/karkl/Desktop/NCC/datasets/output"
+KEYWORD_IDF_PATH = "C:/Users/karkl/Desktop/NCC/datasets/keyword_idf.json"
+# Topic statistics of the output, read by the streamlit app
+STATS_PATH = "C:/Users/karkl/Desktop/NCC/datasets/topic_stats"
+# Publication date column of the corpus, output partitions
+PARTITION_COLUMN = "date"
+# Number of documents read, preprocessed and scored at once
+BATCH_SIZE = 5000
+# Worker processes preprocessing and finding topics in texts, -1 for all cores
+N_JOBS = -1
+# Documents whose keyword matrices are kept from counting to scoring
+KEPT_DOCUMENTS = 100000
 
-# TODO: Same pipeline keywords / documents. Ensure priors formatted well.
-def point_predict():
+@lru_cache(maxsize=None)
+def load_predictor():
     """
-    This function shows how to point predict the topics of a document.
+    Loads the topic predictor once per process, with the keyword idf
+    of the last full run if any.
     """
-    keywords_topics = pd.read_excel(KEYWORDS_TOPICS_PATH)
+    nlp = spacy.load(knowledge_base.SPACY_MODEL)
+    kb = knowledge_base.load(KEYWORDS_TOPICS_PATH, KNOWLEDGE_BASE_PATH, nlp)
+    idf = KeywordIdf.load(KEYWORD_IDF_PATH, kb.topic_finder.keywords) if os.path.exists(KEYWORD_IDF_PATH) else None
+    return TopicPredictor(kb, nlp, idf)
+
+
+def point_predict(title, text="", k=None, threshold=0.0):
+    """
+    This function shows how to point predict the topics of a document,
+    as (topic, score) pairs best first (see TopicPredictor.predict).
+    """
+    return load_predictor().predict(title, text, k, threshold)
+
+
+
+def predict(incremental=False, batch_size=BATCH_SIZE, since=None):
+    """
+    This functions show how to predict topic from a batch of documents.
+    The corpus is streamed by batches of batch_size documents.
+    With incremental, only documents new or changed since the last run
+    are scored and merged into the output dataset. With since (YYYY-MM-DD),
+    only documents published since then are scored, and merged into the
+    output dataset.
+    Keyword document frequencies are counted over the whole corpus, in the
+    same pass as the keywords of the documents scored, and saved. Full runs
+    reuse them while the corpus and the knowledge base are unchanged.
+    Incremental and since runs reuse them as long as the knowledge base is,
+    so that the documents they do not rewrite keep consistent scores:
+    documents added since are scored without being counted, so a full run
+    is needed once they are a noticeable share of the corpus.
+    When the knowledge base changed since they were counted, every document
+    is scored again, incremental and since runs turning into full runs.
+    """
+    nlp = spacy.load(knowledge_base.SPACY_MODEL)
+    kb = knowledge_base.load(KEYWORDS_TOPICS_PATH, KNOWLEDGE_BASE_PATH, nlp)
+    tfi = kb.topic_finder
+    
+    cache = PreprocessingCache(PREPROCESSING_CACHE_PATH, utils.preprocessing_fingerprint(nlp))
+    key = {"knowledge_base": kb.key, "corpus": corpus_dataset.fingerprint(CORPUS_PATH)}
+    idf = KeywordIdf.load(KEYWORD_IDF_PATH, tfi.keywords) if os.path.exists(KEYWORD_IDF_PATH) else None
+    counted = idf is not None and idf.key is not None and idf.key["knowledge_base"] == kb.key
+    if not counted:
+        # Scores of every document depend on the knowledge base
+        incremental, since = False, None
+    scored = output_dataset.scored_hashes(OUTPUT_PATH, PARTITION_COLUMN) if incremental else None
+    
+    def documents(read_since):
+        """
+        Yields the corpus batches published since read_since, with the mask
+        of their documents scored by this run.
+        """
+        for batch in corpus_dataset.iter_batches(CORPUS_PATH, batch_size, since=read_since):
+            corpus = batch.to_pandas()
+            corpus["text_hash"] = output_dataset.document_hashes(corpus)
+            selected = np.ones(len(corpus), dtype=bool)
+            if since is not None:
+                selected &= (corpus[PARTITION_COLUMN] >= since).to_numpy()
+            if incremental:
+                selected &= output_dataset.changed(corpus, scored)
+            yield corpus, selected
+    
+    # Worker processes started once, reused by every batch
+    with tfi.workers(N_JOBS), utils.workers(nlp, N_JOBS) as pipe:
+        # Counted again when the knowledge base changed, or the corpus for full runs
+        if counted and (incremental or since is not None or idf.key["corpus"] == key["corpus"]):
+            found = None
+        else:
+            # The whole corpus is read twice, its keywords only found once
+            idf = KeywordIdf(tfi.keywords, key=key)
+            found = count_keywords(documents(None), pipe, cache, tfi, idf)
+            idf.save(KEYWORD_IDF_PATH)
     
-    # Format keywords
-    keywords_topics = pd.DataFrame(keywords_topics.stack().droplevel(0), columns=["word"])
-    keywords_topics = keywords_topics.reset_index().rename(columns={"index": "topic"})
-    keywords_topics = keywords_topics.groupby(["topic"]).agg({"word": lambda x: list(x)})
+        def outputs():
+            matrices = iter(found or [])
+            for corpus, selected in documents(since):
+                ids, title_matrix, text_matrix = next(matrices, (None, None, None))
+                corpus = corpus[selected].reset_index(drop=True)
+                # Keywords found by count_keywords, unless the corpus changed since
+                keyword_matrices = (title_matrix, text_matrix) if np.array_equal(ids, corpus["id"]) else None
+                if len(corpus) > 0:
+                    yield score(corpus, pipe, cache, tfi, idf, keyword_matrices)
     
+        if incremental or since is not None:
+            dates = set()
+            for output in outputs():
+                dates |= output_dataset.write(output, OUTPUT_PATH, PARTITION_COLUMN, merge=True)
+        else:
+            output_dataset.write_batches(outputs(), OUTPUT_PATH, PARTITION_COLUMN)
+            dates = None
+    # Dashboard statistics, recomputed for the dates written only
+    analytics.update(STATS_PATH, OUTPUT_PATH, dates)
+    cache.close()
 
-def predict():
+
+def count_keywords(documents, pipe, cache, tfi, idf):
     """
-    This functions show how to predict topic from a batch of documents.
+    Adds the documents of an iterable of (corpus batch, mask) to the
+    keyword document frequencies of idf. Returns, for each batch, the ids
+    and the title and text keyword matrices of its documents in mask,
+    so that scoring them does not find their keywords again. Past the
+    first KEPT_DOCUMENTS documents, their keywords are found again.
     """
-    corpus = pd.read_parquet(CORPUS_PATH)
-    keywords_topics = pd.read_excel(KEYWORDS_TOPICS_PATH)
-    nlp = spacy.load("fr_core_news_sm")
-        
-    # Format keywords to ["topic", "keywords"] table
-    keywords_topics = pd.DataFrame(keywords_topics.stack().droplevel(0), columns=["words"])
-    keywords_topics["words"] = keywords_topics["words"].apply(lambda x: utils.preprocess_string(nlp, x))
-    keywords_topics = keywords_topics.reset_index().rename(columns={"index": "topic"})
-    keywords_topics = keywords_topics.groupby(["topic"]).agg({"words": lambda x: list(x)}).reset_index()
-    
-    # String preprocessing !!! 
-    # TODO: Super long, optimize this with nlp.pipe much faster
-    corpus["text"] = corpus["text"].apply(lambda x: utils.preprocess_string(nlp, x))
-    corpus["titre"] = corpus["titre"].apply(lambda x: utils.preprocess_string(nlp, x))
-    
-    # Find keywords and topics
-    tfi = TopicFinder(keywords_topics)
-    found_title = tfi.column_extract_topics(corpus["titre"])
-    found_text = tfi.column_extract_topics(corpus["text"])
-        
-    # Join both datasets
-    found_title["words"] += found_text["words"]
-    found_title["topics"] += found_text["topics"]
-    found_title["words"] = found_title["words"].apply(lambda x: list(set(x)))
-    found_title["topics"] = found_title["topics"].apply(lambda x: list(set(x)))
-    
-    # Save an output table
-    output_dataset = pd.concat([corpus, found_title], axis=1)
-    output_dataset.to_parquet("C:/Users/karkl/Desktop/NCC/datasets/output3.parquet")
+    found = []
+    kept = 0
+    for corpus, selected in documents:
+        title_matrix, text_matrix = find_keywords(corpus, pipe, cache, tfi)
+        idf.update(title_matrix + text_matrix)
+        kept += selected.sum()
+        if kept <= KEPT_DOCUMENTS:
+            found.append((corpus["id"][selected].to_numpy(), title_matrix[selected], text_matrix[selected]))
+        else:
+            found.append((None, None, None))
+    return found
+
+
+def preprocess(corpus, pipe, cache):
+    """
+    Preprocesses the titles and texts of a batch of documents in place,
+    with a function yielded by preprocessing_utils.workers.
+    """
+    # String preprocessing, batched through nlp.pipe (on the workers for
+    # texts), reusing documents already preprocessed by previous runs
+    for column in ["text", "titre"]:
+        corpus[column] = cache.preprocess(
+            column, corpus["id"], corpus[column], lambda x: pipe(x, parallel=column == "text")
+        )
+
+
+def find_keywords(corpus, pipe, cache, tfi):
+    """
+    Preprocesses a batch of documents in place and returns their
+    title and text document x keyword matrices.
+    """
+    preprocess(corpus, pipe, cache)
+    title_matrix = tfi.column_keyword_matrix(corpus["titre"])
+    text_matrix = tfi.column_keyword_matrix(corpus["text"], n_jobs=N_JOBS)
+    return title_matrix, text_matrix
+
+
+def score(corpus, pipe, cache, tfi, idf, keyword_matrices=None):
+    """
+    Preprocesses a batch of documents and finds their words and topics,
+    with the tf-idf score of each topic (see TopicFinder.topic_scores).
+    Their title and text keyword matrices are only found when not given.
+    Scores are kept whole: analytics.cut_topics leaves out the topics
+    scoring below the threshold of the dashboard when reading.
+    """
+    if keyword_matrices is None:
+        title_matrix, text_matrix = find_keywords(corpus, pipe, cache, tfi)
+    else:
+        preprocess(corpus, pipe, cache)
+        title_matrix, text_matrix = keyword_matrices
+    keyword_matrix = title_matrix + text_matrix
+    topic_scores = tfi.topic_scores(
+        title_matrix,
+        text_matrix,
+        corpus["titre"].str.split().str.len().fillna(0),
+        corpus["text"].str.split().str.len().fillna(0),
+        idf,
+    )
     
+    # Output table
+    found = pd.DataFrame(
+        {
+            "words": matrix_to_lists(keyword_matrix, tfi.keywords),
+            "topics": matrix_to_lists(topic_scores, tfi.topics),
+            "topic_scores": matrix_to_values(topic_scores),
+        }
+    )
+    return pd.concat([corpus, found], axis=1)
+    
+
+def serve(host=service.HOST, port=service.PORT):
+    """
+    This function serves topics over HTTP (see service.py),
+    keeping the compiled keywords in memory.
+    """
+    nlp = spacy.load(knowledge_base.SPACY_MODEL)
+    kb = knowledge_base.load(KEYWORDS_TOPICS_PATH, KNOWLEDGE_BASE_PATH, nlp)
+    asyncio.run(service.serve(service.TopicService(kb.topic_finder, nlp), host, port))
+
+
 if __name__ == "__main__":
-    point_predict()
-    predict()
+    if sys.argv[1:2] == ["serve"]:
+        serve()
+    else:
+        since = [arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--since=")]
+        predict(incremental="--incremental" in sys.argv, since=since[0] if since else None)
     
@@ -0,0 +1,164 @@
+"""
+This file computes the topic statistics of the output dataset, stored as
+parquet aggregates so that the streamlit app reads them instead of
+aggregating documents.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import corpus_dataset
+
+# Columns the documents of each topic are counted by
+GROUP_COLUMNS = ["date", "nature", "emetteur"]
+COUNTS_FILE = "topic_counts.parquet"
+COOCCURRENCE_FILE = "topic_cooccurrence.parquet"
+COUNTS_SCHEMA = pa.schema(
+    [(name, pa.string()) for name in GROUP_COLUMNS + ["topic"]]
+    + [("count", pa.int64())]
+)
+COOCCURRENCE_SCHEMA = pa.schema(
+    [(name, pa.string()) for name in ["date", "topic1", "topic2"]]
+    + [("count", pa.int64())]
+)
+# Topics scoring at most this are left out of the statistics: about a
+# single occurrence of a keyword of idf 1 in a text of 1000 words
+SCORE_THRESHOLD = 0.001
+
+
+def cut_topics(documents: pa.Table, threshold=SCORE_THRESHOLD) -> pa.Table:
+    """
+    Returns documents with, in their topics and topic_scores columns,
+    only the topics scoring above threshold.
+    """
+    scores = documents["topic_scores"].combine_chunks()
+    kept = pc.greater(pc.list_flatten(scores), threshold)
+    parents = pc.list_parent_indices(scores).filter(kept).to_numpy()
+    lengths = np.bincount(parents, minlength=len(documents))
+    offsets = pa.array(np.concatenate([[0], np.cumsum(lengths)]), pa.int32())
+    for name in ["topics", "topic_scores"]:
+        values = pc.list_flatten(documents[name].combine_chunks())
+        documents = documents.set_column(
+            documents.schema.get_field_index(name),
+            name,
+            pa.ListArray.from_arrays(offsets, values.filter(kept)),
+        )
+    return documents
+
+
+def explode_topics(documents: pa.Table) -> pa.Table:
+    """
+    One row per (document, topic) of documents with the topics and
+    GROUP_COLUMNS columns, documents being numbered by their row.
+    """
+    parents = pc.list_parent_indices(documents["topics"])
+    columns = {
+        "document": parents,
+        "topic": pc.list_flatten(documents["topics"]),
+    }
+    for name in GROUP_COLUMNS:
+        columns[name] = documents[name].take(parents)
+    return pa.table(columns)
+
+
+def topic_counts(exploded: pa.Table) -> pa.Table:
+    """
+    Number of documents of each topic, by GROUP_COLUMNS.
+    """
+    keys = GROUP_COLUMNS + ["topic"]
+    counts = exploded.group_by(keys).aggregate([("document", "count")])
+    return pa.table(
+        [counts[name] for name in keys] + [counts["document_count"]],
+        names=COUNTS_SCHEMA.names,
+    ).cast(COUNTS_SCHEMA)
+
+
+def cooccurrences(exploded: pa.Table) -> pa.Table:
+    """
+    Number of documents of each pair of topics (topic1 < topic2), by date.
+    """
+    pairs = exploded.select(["document", "date", "topic"]).join(
+        exploded.select(["document", "topic"]),
+        keys="document",
+        left_suffix="1",
+        right_suffix="2",
+    )
+    pairs = pairs.filter(pc.less(pairs["topic1"], pairs["topic2"]))
+    keys = ["date", "topic1", "topic2"]
+    counts = pairs.group_by(keys).aggregate([("document", "count")])
+    return pa.table(
+        [counts[name] for name in keys] + [counts["document_count"]],
+        names=COOCCURRENCE_SCHEMA.names,
+    ).cast(COOCCURRENCE_SCHEMA)
+
+
+def aggregate(documents: pa.Table) -> dict:
+    """
+    Returns the aggregates of documents, by file name, counting only
+    their topics scoring above SCORE_THRESHOLD.
+    """
+    exploded = explode_topics(cut_topics(documents))
+    return {
+        COUNTS_FILE: topic_counts(exploded),
+        COOCCURRENCE_FILE: cooccurrences(exploded),
+    }
+
+
+def update(path: str, output_path: str, dates=None):
+    """
+    Recomputes the aggregates of the documents published on dates
+    (all when None) from the output dataset at output_path, replacing
+    their previous rows in the folder path.
+    """
+    if not os.path.exists(output_path) or (dates is not None and not dates):
+        return
+    date_filter = None
+    if dates is not None:
+        date_filter = ds.field("date").isin(sorted(dates))
+    documents = corpus_dataset.dataset(output_path).to_table(
+        columns=["topics", "topic_scores"] + GROUP_COLUMNS,
+        filter=date_filter,
+    )
+
+    os.makedirs(path, exist_ok=True)
+    for file_name, table in aggregate(documents).items():
+        file = os.path.join(path, file_name)
+        if date_filter is not None and os.path.exists(file):
+            kept = pq.read_table(file, filters=~date_filter)
+            table = pa.concat_tables([kept, table.cast(kept.schema)])
+        # Written aside then moved, never leaving a partial file
+        pq.write_table(
+            table.sort_by("date"),
+            file + ".tmp",
+            compression=corpus_dataset.COMPRESSION,
+            compression_level=corpus_dataset.COMPRESSION_LEVEL,
+        )
+        os.replace(file + ".tmp", file)
+
+
+def fingerprint(
+    path: str, file_name: str, since: str = None, until: str = None
+) -> str:
+    """
+    Hash of the size and modification time of an aggregate, with the date
+    bounds read: it changes whenever update writes it, without reading it.
+    """
+    stat = os.stat(os.path.join(path, file_name))
+    key = (file_name, stat.st_size, stat.st_mtime_ns, since, until)
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def read(path: str, file_name: str, since: str = None, until: str = None):
+    """
+    Reads an aggregate of the documents published between since and until.
+    """
+    return pq.read_table(
+        os.path.join(path, file_name),
+        filters=corpus_dataset.date_filter(since, until),
+    ).to_pandas()
@@ -0,0 +1,797 @@
+"""
+This file implements benchmarks of the topic finder pipeline.
+
+Run from the modules folder, e.g. `python benchmarks.py topics`.
+"""
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import spacy
+import analytics
+import corpus_dataset
+import extract_european_texts as eurlex
+import extract_legipeche as legifrance
+import knowledge_base
+import preprocessing_utils as utils
+from eurlex_mock import MockEurLex
+from knowledge_base import KnowledgeBase
+from legifrance_mock import MockLegifrance
+from preprocessing_cache import PreprocessingCache
+from response_cache import ResponseCache
+from service import TopicService
+from topicfinder import KeywordIdf, TopicFinder
+from topicpredictor import TopicPredictor
+
+# Fragments shaped like JORF texts, with the structures normalize handles
+JORF_FRAGMENTS = [
+    "Arrêté du 1er octobre 2021",
+    "portant création d'une zone économique exclusive",
+    "(n° 2021-1234)",
+    "Le ministre de l'Agriculture et de l'Alimentation,",
+    "«\u00a0pêche maritime\u00a0»",
+    "Vu le code rural et de la pêche maritime, notamment son article L. 2 ;",
+    "Article 1er\n\nLes navires mentionnés au 2° de l’article 3",
+    "\tDÉCRÈTE :",
+]
+JORF_WORDS = (
+    "le la les de des du et à au pour par dans est sont article arrêté "
+    "décret ministre ministère pêche maritime zone économique navire "
+    "espèces quota autorisation délivrée préfet région conformément "
+    "dispositions présent code rural"
+).split()
+
+
+def synthetic_topics(n_topics=14, n_words=30, vocabulary_size=5000, seed=0):
+    """
+    Creates a random ["topic", "words"] table shaped like topic_knownledge.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"mot{i}" for i in range(vocabulary_size)]
+    return pd.DataFrame(
+        {
+            "topic": [f"TOPIC {i}" for i in range(n_topics)],
+            "words": [
+                rng.sample(vocabulary, n_words) for _ in range(n_topics)
+            ],
+        }
+    )
+
+
+def synthetic_corpus(
+    n_documents=2000, n_tokens=500, vocabulary_size=5000, seed=0
+):
+    """
+    Creates a Series of random normalized documents.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"mot{i}" for i in range(vocabulary_size)]
+    return pd.Series(
+        [
+            " ".join(rng.choices(vocabulary, k=n_tokens))
+            for _ in range(n_documents)
+        ]
+    )
+
+
+def timed(function, *args):
+    """
+    Returns the result of function(*args) and its duration in seconds.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+"""##########"""
+"""Benchmarks"""
+"""##########"""
+
+
+def _legacy_extract_topics(tfi, input_string):
+    """
+    Topic extraction as implemented before the inverted index:
+    one scan of the document per topic.
+    """
+    words_found = []
+    topics_found = []
+    for topic_name, list_words in zip(tfi.topic_column, tfi.words_column):
+        matches = list(
+            {match for match in input_string.split() if match in list_words}
+        )
+        if matches != []:
+            topics_found.append(topic_name)
+            words_found += matches
+    return list(set(words_found)), topics_found
+
+
+def bench_topics():
+    """
+    Compares the per-topic scan with the inverted keyword index.
+    """
+    tfi = TopicFinder(synthetic_topics())
+    corpus = synthetic_corpus()
+
+    legacy, legacy_time = timed(
+        lambda: [_legacy_extract_topics(tfi, doc) for doc in corpus]
+    )
+    indexed, indexed_time = timed(
+        lambda: [tfi.extract_topics(doc) for doc in corpus]
+    )
+
+    for (legacy_words, legacy_topics), (words, topics) in zip(legacy, indexed):
+        assert sorted(legacy_words) == sorted(words)
+        assert legacy_topics == topics
+
+    print(f"{len(corpus)} documents")
+    print(f"per-topic scan: {legacy_time:.3f}s")
+    print(
+        f"inverted index: {indexed_time:.3f}s "
+        f"({legacy_time / indexed_time:.1f}x)"
+    )
+
+
+def bench_phrases():
+    """
+    Compares single-word matching with the phrase automaton, which also
+    finds multi-word keywords, on the same corpus.
+    """
+    topics = synthetic_topics()
+    # Turn a third of the keywords into two-word phrases
+    topics["words"] = topics["words"].map(
+        lambda words: [
+            f"{word} {words[i - 1]}" if i % 3 == 0 else word
+            for i, word in enumerate(words)
+        ]
+    )
+    corpus = synthetic_corpus()
+    single = TopicFinder(topics)
+    phrases = TopicFinder(topics, match_phrases=True)
+
+    single_found, single_time = timed(
+        lambda: [single.extract_topics(doc) for doc in corpus]
+    )
+    phrase_found, phrase_time = timed(
+        lambda: [phrases.extract_topics(doc) for doc in corpus]
+    )
+
+    # Every single-word match is still found by the automaton
+    for (single_words, _), (phrase_words, _) in zip(
+        single_found, phrase_found
+    ):
+        assert set(single_words) <= set(phrase_words)
+
+    n_single = sum(len(words) for words, _ in single_found)
+    n_phrase = sum(len(words) for words, _ in phrase_found)
+    print(f"{len(corpus)} documents")
+    print(f"single words: {single_time:.3f}s, {n_single} keywords found")
+    print(f"automaton:    {phrase_time:.3f}s, {n_phrase} keywords found")
+
+
+def bench_normalize(size=4_000_000):
+    """
+    Checks normalize against the chain of sub-functions it replaces
+    (golden output) and compares both on a multi-megabyte text.
+    """
+    rng = random.Random(0)
+    text = ""
+    while len(text) < size:
+        text += " ".join(rng.choices(JORF_WORDS, k=300)) + " "
+        text += " ".join(rng.choices(JORF_FRAGMENTS, k=3)) + "\n"
+
+    # Golden output on single fragments, random samples and the full text
+    samples = JORF_FRAGMENTS + [
+        "".join(rng.choices(" ".join(JORF_FRAGMENTS), k=50))
+        for _ in range(10000)
+    ]
+    for sample in samples:
+        assert utils.normalize(sample) == utils.legacy_normalize(sample)
+
+    legacy, legacy_time = timed(utils.legacy_normalize, text)
+    compiled, compiled_time = timed(utils.normalize, text)
+    assert compiled == legacy
+
+    print(f"{len(text) / 1e6:.1f}M characters")
+    print(f"sub-functions: {legacy_time:.3f}s")
+    print(
+        f"normalize:     {compiled_time:.3f}s "
+        f"({legacy_time / compiled_time:.1f}x)"
+    )
+
+
+def bench_series(n_rows=100_000):
+    """
+    Compares row by row normalization with preprocess_series on a column.
+    """
+    rng = random.Random(0)
+    column = pd.Series(
+        [
+            " ".join(rng.choices(JORF_WORDS, k=15))
+            + " "
+            + rng.choice(JORF_FRAGMENTS)
+            for _ in range(n_rows)
+        ]
+    )
+
+    legacy, legacy_time = timed(column.apply, utils.legacy_normalize)
+    mapped, mapped_time = timed(column.map, utils.normalize)
+    vectorized, vectorized_time = timed(utils.preprocess_series, column)
+    assert legacy.equals(mapped)
+    assert (legacy == vectorized).all()
+
+    print(f"{n_rows} rows")
+    print(f"apply sub-functions: {legacy_time:.3f}s")
+    print(f"map normalize:       {mapped_time:.3f}s")
+    print(f"preprocess_series:   {vectorized_time:.3f}s")
+
+
+def bench_preprocessing(n_documents=5000, n_tokens=300, changed=0.1):
+    """
+    Seconds to preprocess a corpus through a cold then warm preprocessing
+    cache, after editing a share of the texts, and after a change of the
+    spaCy pipeline, which must invalidate every entry.
+    """
+    rng = random.Random(0)
+    ids = [f"JORFTEXT{i:012d}" for i in range(n_documents)]
+    texts = pd.Series(
+        [
+            " ".join(rng.choices(JORF_WORDS, k=n_tokens))
+            + " "
+            + rng.choice(JORF_FRAGMENTS)
+            for _ in range(n_documents)
+        ]
+    )
+    edited = texts.copy()
+    n_changed = int(n_documents * changed)
+    edited.iloc[:n_changed] = edited.iloc[:n_changed] + " modifié"
+
+    nlp = spacy.blank("fr")
+    other = spacy.blank("fr")
+    other.add_pipe("sentencizer")
+    fingerprint = utils.preprocessing_fingerprint(nlp)
+    assert utils.preprocessing_fingerprint(other) != fingerprint
+
+    calls = []
+
+    def preprocess(texts):
+        calls.append(len(texts))
+        return utils.preprocess_corpus(nlp, texts)
+
+    print(f"{n_documents} documents of {n_tokens} words")
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "preprocessing.sqlite")
+        cache = PreprocessingCache(path, fingerprint)
+        for name, column in [
+            ("cold", texts),
+            ("warm", texts),
+            ("edited", edited),
+        ]:
+            calls.clear()
+            output, duration = timed(
+                cache.preprocess, "text", ids, column, preprocess
+            )
+            assert output == list(utils.preprocess_corpus(nlp, column))
+            print(
+                f"{name}: {duration:.2f}s, "
+                f"{sum(calls)} documents preprocessed"
+            )
+            if name == "warm":
+                assert not calls
+            if name == "edited":
+                assert sum(calls) == n_changed
+        cache.close()
+
+        cache = PreprocessingCache(
+            path, utils.preprocessing_fingerprint(other)
+        )
+        stale = cache.lookup("text", ids, edited)
+        assert all(processed is None for processed in stale)
+        cache.close()
+        print("pipeline change: every entry invalidated")
+
+
+def bench_jobs():
+    """
+    Throughput of column_extract_topics for increasing numbers of jobs.
+    """
+    tfi = TopicFinder(synthetic_topics(), match_phrases=True)
+    corpus = synthetic_corpus(n_documents=20000)
+    expected, single_time = timed(tfi.column_extract_topics, corpus)
+
+    print(f"{len(corpus)} documents, {os.cpu_count()} cores")
+    print(f"n_jobs=1: {len(corpus) / single_time:.0f} documents/s")
+    n_jobs = 2
+    while n_jobs <= os.cpu_count():
+        found, duration = timed(tfi.column_extract_topics, corpus, n_jobs)
+        assert found["topics"].equals(expected["topics"])
+        print(
+            f"n_jobs={n_jobs}: {len(corpus) / duration:.0f} documents/s "
+            f"({single_time / duration:.1f}x)"
+        )
+        n_jobs *= 2
+
+
+def _french_word(i):
+    """
+    Letters only word from an integer, surviving normalize.
+    """
+    letters = ""
+    while True:
+        i, rest = divmod(i, 26)
+        letters += chr(ord("a") + rest)
+        if i == 0:
+            return "terme" + letters
+
+
+@spacy.Language.component("identity_lemmatizer")
+def _identity_lemmatizer(doc):
+    """
+    Sets the lemma of each token to its text, as a lookup lemmatizer
+    without its table.
+    """
+    for token in doc:
+        token.lemma_ = token.text
+    return doc
+
+
+def bench_point(n_documents=2000, title_tokens=15, text_tokens=600):
+    """
+    Latency of TopicPredictor.predict on single raw documents,
+    with the scores of the batch TopicFinder.topic_scores as reference,
+    only normalized then lemmatized by the configured spaCy pipeline.
+    """
+    rng = random.Random(0)
+    vocabulary = [_french_word(i) for i in range(5000)]
+    topics = pd.DataFrame(
+        {
+            "topic": [f"TOPIC {i}" for i in range(14)],
+            "words": [rng.sample(vocabulary, 30) for _ in range(14)],
+        }
+    )
+    kb = KnowledgeBase(topics, key={})
+
+    def document(n_tokens):
+        words = rng.choices(JORF_WORDS, k=n_tokens - n_tokens // 20)
+        words += rng.choices(vocabulary, k=n_tokens // 20)
+        rng.shuffle(words)
+        return rng.choice(JORF_FRAGMENTS) + " " + " ".join(words)
+
+    titles = [document(title_tokens) for _ in range(n_documents)]
+    texts = [document(text_tokens) for _ in range(n_documents)]
+
+    # Reference scores of the batch pipeline
+    tfi = kb.topic_finder
+    title_column = utils.preprocess_series(pd.Series(titles))
+    text_column = utils.preprocess_series(pd.Series(texts))
+    title_matrix = tfi.column_keyword_matrix(title_column)
+    text_matrix = tfi.column_keyword_matrix(text_column)
+    idf = KeywordIdf(tfi.keywords)
+    idf.update(title_matrix + text_matrix)
+    expected = tfi.topic_scores(
+        title_matrix,
+        text_matrix,
+        title_column.str.split().str.len(),
+        text_column.str.split().str.len(),
+        idf,
+    ).toarray()
+
+    predictor = TopicPredictor(kb, idf=idf)
+    for i in range(n_documents):
+        found = dict(predictor.predict(titles[i], texts[i]))
+        row = {tfi.topics[j]: s for j, s in enumerate(expected[i]) if s}
+        assert found.keys() == row.keys()
+        assert np.allclose([found[t] for t in row], list(row.values()))
+
+    # Pipeline of the service and point_predict, or its tokenizer and
+    # a lookup lemmatizer stand-in when the model is not installed
+    if spacy.util.is_package(knowledge_base.SPACY_MODEL):
+        nlp = spacy.load(knowledge_base.SPACY_MODEL)
+        nlp_name = knowledge_base.SPACY_MODEL
+    else:
+        nlp = spacy.blank("fr")
+        nlp.add_pipe("identity_lemmatizer")
+        nlp_name = f"{knowledge_base.SPACY_MODEL} stand-in"
+    nlp_predictor = TopicPredictor(kb, nlp, idf)
+    sample = titles[:100] + texts[:100]
+    assert [nlp_predictor.tokens(x) for x in sample] == [
+        x.split() for x in utils.preprocess_corpus(nlp, sample)
+    ]
+
+    print(f"{n_documents} documents")
+    for predictor_name, point_predictor in [
+        ("nlp=None", predictor),
+        (f"nlp={nlp_name}", nlp_predictor),
+    ]:
+        for name, pairs in [
+            (f"title ({title_tokens} tokens)", [(t, "") for t in titles]),
+            (
+                f"title + text ({text_tokens} tokens)",
+                list(zip(titles, texts)),
+            ),
+        ]:
+            latencies = []
+            for title, text in pairs:
+                start = time.perf_counter()
+                point_predictor.predict(title, text)
+                latencies.append(time.perf_counter() - start)
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1e6
+            print(
+                f"{predictor_name}, {name}: "
+                f"p50 {p50:.0f} µs, p99 {p99:.0f} µs"
+            )
+
+
+async def load_test(host, port, documents, n_requests, concurrency):
+    """
+    Posts n_requests documents to the topic service from concurrency
+    keep-alive connections, returns the latency of each request.
+    """
+    latencies = []
+    sent = iter(range(n_requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in sent:
+            body = json.dumps(documents[i % len(documents)]).encode()
+            start = time.perf_counter()
+            writer.write(
+                (
+                    "POST /topics HTTP/1.1\r\n"
+                    f"Host: {host}\r\nContent-Length: {len(body)}\r\n\r\n"
+                ).encode()
+                + body
+            )
+            status = await reader.readline()
+            assert status.startswith(b"HTTP/1.1 200"), status
+            length = 0
+            while (line := await reader.readline()) != b"\r\n":
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            json.loads(await reader.readexactly(length))
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        await writer.wait_closed()
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies
+
+
+def bench_service(n_requests=5000):
+    """
+    Throughput and latencies of the topic service under local load,
+    by number of concurrent clients.
+    """
+    rng = random.Random(0)
+    tfi = TopicFinder(synthetic_topics(), match_phrases=True)
+    vocabulary = tfi.keywords + JORF_WORDS
+    documents = [
+        {
+            "title": " ".join(rng.choices(vocabulary, k=15)),
+            "text": " ".join(rng.choices(vocabulary, k=600)),
+        }
+        for _ in range(500)
+    ]
+
+    async def run(concurrency):
+        service = TopicService(tfi)
+        server = await service.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        latencies, duration = await load_test_timed(port, concurrency)
+        metrics = service.metrics.snapshot()
+        await service.close()
+        return latencies, duration, metrics
+
+    async def load_test_timed(port, concurrency):
+        start = time.perf_counter()
+        latencies = await load_test(
+            "127.0.0.1", port, documents, n_requests, concurrency
+        )
+        return latencies, time.perf_counter() - start
+
+    print(f"{n_requests} requests, 600-token texts")
+    for concurrency in [1, 8, 64]:
+        latencies, duration, metrics = asyncio.run(run(concurrency))
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(
+            f"{concurrency} clients: {n_requests / duration:.0f} requests/s, "
+            f"p50 {p50:.1f} ms, p99 {p99:.1f} ms, "
+            f"mean batch {metrics['mean_batch_size']:.1f}"
+        )
+
+
+def bench_fetch(n_texts=400, latency=0.02):
+    """
+    Texts fetched per second from a mock API answering in latency seconds,
+    by number of concurrent requests.
+    """
+    mock = MockLegifrance(1, n_texts, latency).start()
+    ids = [mock.text_id(1, i) for i in range(n_texts)]
+
+    print(f"{n_texts} texts, {latency * 1000:.0f} ms per request")
+    expected = None
+    for concurrency in [1, 8, 32]:
+        client = legifrance.LegifranceClient(
+            lambda: legifrance.get_token(mock.url + "/token"),
+            mock.url,
+            concurrency=concurrency,
+            rate_limit=1000,
+        )
+        contents, duration = timed(
+            lambda: list(client.map(legifrance.fetch_text_content, ids))
+        )
+        assert expected is None or contents == expected
+        expected = contents
+        print(f"concurrency={concurrency}: {n_texts / duration:.0f} texts/s")
+    mock.stop()
+
+
+def bench_european(n_days=10, works_per_day=40, latency=0.02):
+    """
+    Documents harvested per second from a mock EUR-Lex answering in
+    latency seconds, by number of concurrent requests.
+    """
+    mock = MockEurLex(works_per_day, latency).start()
+    end_date = datetime.datetime(2021, 10, 16)
+    start_date = end_date - datetime.timedelta(days=n_days)
+
+    print(f"{n_days} days of {works_per_day} works, {latency * 1000:.0f} ms")
+    expected = None
+    for concurrency in [1, 8, 32]:
+        client = eurlex.EurLexClient(
+            mock.url + "/webapi/rdf/sparql",
+            mock.url + "/resource",
+            concurrency=concurrency,
+        )
+        documents, duration = timed(
+            lambda: list(eurlex.harvest(client, start_date, end_date))
+        )
+        assert expected is None or documents == expected
+        expected = documents
+        n_documents = sum(len(records) for records in documents)
+        print(
+            f"concurrency={concurrency}: {n_documents} documents, "
+            f"{n_documents / duration:.0f} documents/s"
+        )
+    mock.stop()
+
+
+def bench_cache(n_days=10, works_per_day=40, latency=0.02):
+    """
+    Seconds to harvest from a mock EUR-Lex answering in latency seconds,
+    with a cold, warm and stale (revalidated) response cache.
+    """
+    mock = MockEurLex(works_per_day, latency).start()
+    end_date = datetime.datetime(2021, 10, 16)
+    start_date = end_date - datetime.timedelta(days=n_days)
+
+    print(f"{n_days} days of {works_per_day} works, {latency * 1000:.0f} ms")
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "cache.sqlite")
+        expected = None
+        for name, max_age in [("cold", 3600), ("warm", 3600), ("stale", 0)]:
+            client = eurlex.EurLexClient(
+                mock.url + "/webapi/rdf/sparql",
+                mock.url + "/resource",
+                cache=ResponseCache(path, max_age=max_age),
+            )
+            mock.requests = 0
+            documents, duration = timed(
+                lambda: list(eurlex.harvest(client, start_date, end_date))
+            )
+            assert expected is None or documents == expected
+            expected = documents
+            client.cache.close()
+            print(f"{name}: {duration:.2f}s, {mock.requests} requests")
+    mock.stop()
+
+
+def bench_sink(works_per_day=100, text_size=2000):
+    """
+    Seconds to store harvests of growing length, appended by batches to
+    the corpus dataset then compacted, against growing a DataFrame by
+    record and rewriting its csv every day.
+    """
+    text = " ".join(JORF_WORDS) * (text_size // 250)
+    print(f"{works_per_day} documents per day, {len(text)} characters")
+    for n_days in [4, 8, 16]:
+        days = [
+            [
+                {
+                    "cellar_uri": f"cellar/{day}-{i}",
+                    "date": f"2021-{1 + day // 28:02d}-{1 + day % 28:02d}",
+                    "title": f"Règlement {i}",
+                    "topics": "pêche maritime",
+                    "text": text,
+                }
+                for i in range(works_per_day)
+            ]
+            for day in range(n_days)
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+
+            def legacy():
+                df = pd.DataFrame(columns=[])
+                for records in days:
+                    for record in records:
+                        df = pd.concat([df, pd.DataFrame([record])])
+                    df.to_csv(os.path.join(folder, "legacy.csv"), index=False)
+
+            def sink():
+                path = os.path.join(folder, "corpus")
+                with corpus_dataset.CorpusWriter(
+                    path, schema=eurlex.SCHEMA
+                ) as writer:
+                    for records in days:
+                        writer.append(
+                            pd.DataFrame.from_records(
+                                records, columns=eurlex.COLUMNS
+                            )
+                        )
+                corpus_dataset.compact(path, key="cellar_uri")
+
+            _, legacy_time = timed(legacy)
+            _, duration = timed(sink)
+        print(
+            f"{n_days} days: {duration:.2f}s, legacy {legacy_time:.2f}s "
+            f"({legacy_time / duration:.0f}x)"
+        )
+
+
+def bench_analytics(n_documents=300_000, n_topics=14, seed=0):
+    """
+    Seconds to aggregate the topic statistics of a scored output once,
+    against the per row aggregations the dashboard ran on each rerun.
+    """
+    rng = random.Random(seed)
+    topics = [f"TOPIC {i}" for i in range(n_topics)]
+    document_topics = [
+        rng.sample(topics, rng.randint(0, 4)) for _ in range(n_documents)
+    ]
+    output = pd.DataFrame(
+        {
+            "date": [f"2021-10-{1 + i % 28:02d}" for i in range(n_documents)],
+            "nature": rng.choices(["ARRETE", "DECRET", "LOI"], k=n_documents),
+            "emetteur": rng.choices(["MER", "AGRICULTURE"], k=n_documents),
+            "topics": document_topics,
+            "topic_scores": [
+                [rng.choice([0.0005, 0.01, 0.2]) for _ in found]
+                for found in document_topics
+            ],
+        }
+    )
+    table = pa.Table.from_pandas(output, preserve_index=False)
+    aggregates, duration = timed(analytics.aggregate, table)
+    counts = aggregates[analytics.COUNTS_FILE].to_pandas()
+
+    def legacy():
+        output["topics"] = [
+            [
+                topic
+                for topic, score in zip(found, scores)
+                if score > analytics.SCORE_THRESHOLD
+            ]
+            for found, scores in zip(output["topics"], output["topic_scores"])
+        ]
+        cooccurrences = Counter()
+        for date, document_topics in zip(output["date"], output["topics"]):
+            for i in range(len(document_topics)):
+                for j in range(i):
+                    pair = tuple(
+                        sorted((document_topics[i], document_topics[j]))
+                    )
+                    cooccurrences[(date, *pair)] += 1
+        by_nature = output[output["topics"].apply(lambda x: topics[0] in x)][
+            "nature"
+        ].value_counts()
+        return by_nature, cooccurrences
+
+    (expected, expected_pairs), legacy_time = timed(legacy)
+    pairs = aggregates[analytics.COOCCURRENCE_FILE].to_pylist()
+    assert {
+        (row["date"], row["topic1"], row["topic2"]): row["count"]
+        for row in pairs
+    } == dict(expected_pairs)
+    by_nature, read_time = timed(
+        lambda: counts[counts["topic"] == topics[0]]
+        .groupby("nature")["count"]
+        .sum()
+    )
+    assert by_nature.sort_index().tolist() == expected.sort_index().tolist()
+    print(
+        f"{n_documents} documents: aggregated once in {duration:.2f}s, "
+        f"rerun {read_time * 1000:.1f} ms against {legacy_time:.2f}s"
+    )
+
+
+# Article HTML shaped like the content returned by /consult/jorf
+ARTICLE_FRAGMENTS = [
+    "<p>Le pr&eacute;sent arr&ecirc;t&eacute; est applicable.</p>",
+    "<p align='center'>Article 1<sup>er</sup></p>",
+    "<p>Vu le code rural et de la p&ecirc;che maritime ;<br/>Vu l'avis"
+    " du 2 mars 2021,</p>\n",
+    "<table>\n<tr><td>Esp&egrave;ce</td><td>Quota (t)</td></tr>\n"
+    "<tr><td>Sole</td><td>1 200</td></tr>\n</table>",
+    "<ul><li>les navires de plus de 12 m&egrave;tres ;</li>"
+    "<li>les engins remorqu&eacute;s.</li></ul>",
+    "<div><font size='2'>Fait le 1er octobre 2021.</font></div>",
+    "<p>Les dispositions de l&#8217;article 3 &laquo;&nbsp;ZEE&nbsp;"
+    "&raquo; sont abrog&eacute;es.</p>",
+]
+
+
+def synthetic_code(depth=6, branching=3, n_articles=3, seed=0):
+    """
+    Creates a text object of nested sections, shaped like a code.
+    """
+    rng = random.Random(seed)
+
+    def section(level, order):
+        return {
+            "intOrdre": order,
+            "articles": [
+                {
+                    "intOrdre": rng.randint(0, 10),
+                    "content": "".join(rng.choices(ARTICLE_FRAGMENTS, k=4)),
+                }
+                for _ in range(n_articles)
+            ],
+            "sections": [
+                section(level + 1, rng.randint(0, 10))
+                for _ in range(branching if level < depth else 0)
+            ],
+        }
+
+    return section(0, 0)
+
+
+def bench_content():
+    """
+    fast_extract_content_from_text against the legacy extraction,
+    on codes of increasing depth.
+    """
+    for depth in [2, 4, 6]:
+        code = synthetic_code(depth=depth)
+        expected, legacy_time = timed(
+            legifrance.legacy_extract_content_from_text, code, "id"
+        )
+        found, duration = timed(
+            legifrance.fast_extract_content_from_text, code
+        )
+        assert found == expected
+        print(
+            f"depth {depth}, {len(expected) / 1e6:.1f}M chars: "
+            f"legacy {legacy_time:.2f}s, {duration:.2f}s "
+            f"({legacy_time / duration:.0f}x)"
+        )
+
+
+BENCHMARKS = {
+    "topics": bench_topics,
+    "phrases": bench_phrases,
+    "normalize": bench_normalize,
+    "series": bench_series,
+    "preprocessing": bench_preprocessing,
+    "jobs": bench_jobs,
+    "point": bench_point,
+    "service": bench_service,
+    "fetch": bench_fetch,
+    "european": bench_european,
+    "cache": bench_cache,
+    "sink": bench_sink,
+    "analytics": bench_analytics,
+    "content": bench_content,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"--- {name}")
+        BENCHMARKS[name]()
@@ -0,0 +1,226 @@
+"""
+This file implements the storage of the harvested corpus: a zstd compressed
+parquet dataset partitioned by publication date, appended to by batches.
+"""
+
+import hashlib
+import os
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+COLUMNS = [
+    "id",
+    "jorf_cont_id",
+    "date",
+    "emetteur",
+    "nature",
+    "titre",
+    "text",
+]
+SCHEMA = pa.schema([(name, pa.string()) for name in COLUMNS])
+# Publication date column, stored as date=YYYY-MM-DD folders
+PARTITION_COLUMN = "date"
+COMPRESSION = "zstd"
+COMPRESSION_LEVEL = 6
+# Number of documents buffered by CorpusWriter before being written
+BATCH_SIZE = 1000
+
+
+def dataset(path: str) -> ds.Dataset:
+    """
+    Opens a dataset partitioned by date, whose values are read as strings.
+    """
+    partitioning = ds.partitioning(
+        pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive"
+    )
+    return ds.dataset(path, format="parquet", partitioning=partitioning)
+
+
+def date_filter(since: str = None, until: str = None):
+    """
+    Filter on publication dates (YYYY-MM-DD, both included),
+    pushed down to the date folders. None without bounds.
+    """
+    expression = None
+    if since is not None:
+        expression = ds.field(PARTITION_COLUMN) >= since
+    if until is not None:
+        bound = ds.field(PARTITION_COLUMN) <= until
+        expression = bound if expression is None else expression & bound
+    return expression
+
+
+def read(
+    path: str, columns: list = None, since: str = None, until: str = None
+) -> pd.DataFrame:
+    """
+    Reads columns of the documents published between since and until.
+    """
+    return (
+        dataset(path)
+        .to_table(columns=columns, filter=date_filter(since, until))
+        .to_pandas()
+    )
+
+
+def iter_batches(
+    path: str,
+    batch_size: int,
+    columns: list = None,
+    since: str = None,
+    until: str = None,
+):
+    """
+    Yields record batches of at most batch_size documents
+    published between since and until.
+    """
+    yield from dataset(path).to_batches(
+        columns=columns,
+        filter=date_filter(since, until),
+        batch_size=batch_size,
+    )
+
+
+def fingerprint(path: str, since: str = None, until: str = None) -> str:
+    """
+    Hash of the names, sizes and modification times of the files of the
+    dataset, with the date bounds read: it changes whenever documents
+    are written, without reading them.
+    """
+    h = hashlib.sha1(repr((since, until)).encode())
+    for file in sorted(dataset(path).files):
+        stat = os.stat(file)
+        h.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def read_ids(path: str, column: str = "id") -> set:
+    """
+    Returns the ids of the documents stored, reading only their column.
+    """
+    if not os.path.exists(path):
+        return set()
+    return set(dataset(path).to_table(columns=[column])[column].to_pylist())
+
+
+def _write_file(table: pa.Table, folder: str):
+    """
+    Writes table as a new file of folder, readers never seeing
+    a partial file. File names sort in write order (see _write_order).
+    """
+    file_name = f"part-{time.time_ns():020d}-{uuid.uuid4().hex}.parquet"
+    # Hidden until complete: readers ignore files starting with "."
+    pq.write_table(
+        table,
+        os.path.join(folder, "." + file_name),
+        compression=COMPRESSION,
+        compression_level=COMPRESSION_LEVEL,
+    )
+    os.replace(
+        os.path.join(folder, "." + file_name),
+        os.path.join(folder, file_name),
+    )
+
+
+def _write_order(file_name: str) -> tuple:
+    """
+    Sort key of the files of a folder in write order, files named
+    part-<uuid> before any time was in their name coming first.
+    """
+    return file_name.count("-"), file_name
+
+
+def compact(path: str, key: str = None) -> int:
+    """
+    Rewrites the files appended to each date folder as a single file,
+    keeping the last written document of each key when given (which also
+    drops the duplicates of a compaction interrupted before its cleanup).
+
+    Returns:
+        int: number of folders compacted
+    """
+    compacted = 0
+    for name in sorted(os.listdir(path)):
+        folder = os.path.join(path, name)
+        if not name.startswith(PARTITION_COLUMN + "="):
+            continue
+        files = [
+            os.path.join(folder, file_name)
+            for file_name in sorted(os.listdir(folder), key=_write_order)
+            if file_name.startswith("part-")
+        ]
+        if len(files) < 2:
+            continue
+        table = pa.concat_tables([pq.read_table(file) for file in files])
+        if key is not None:
+            keys = table[key].to_numpy(zero_copy_only=False)
+            _, last = np.unique(keys[::-1], return_index=True)
+            table = table.take(np.sort(len(keys) - 1 - last))
+        _write_file(table, folder)
+        for file in files:
+            os.remove(file)
+        compacted += 1
+    return compacted
+
+
+class CorpusWriter:
+    def __init__(
+        self, path: str, batch_size: int = BATCH_SIZE, schema=SCHEMA
+    ):
+        """
+        Appends documents to the dataset at path, batch_size at a time,
+        as one new file per date of each batch. Documents have the string
+        columns of schema, including PARTITION_COLUMN.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.schema = schema
+        self.buffer = []
+        self.buffered = 0
+
+    def append(self, documents: pd.DataFrame):
+        """
+        Buffers documents with the columns of the schema,
+        writing them once batch_size are buffered.
+        """
+        self.buffer.append(documents)
+        self.buffered += len(documents)
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered documents.
+        """
+        if self.buffered == 0:
+            return
+        table = pa.Table.from_pandas(
+            pd.concat(self.buffer)[self.schema.names],
+            schema=self.schema,
+            preserve_index=False,
+        )
+        self.buffer = []
+        self.buffered = 0
+
+        dates = table[PARTITION_COLUMN]
+        table = table.drop_columns([PARTITION_COLUMN])
+        for date in dates.unique().to_pylist():
+            folder = os.path.join(self.path, f"{PARTITION_COLUMN}={date}")
+            os.makedirs(folder, exist_ok=True)
+            _write_file(table.filter(pc.equal(dates, date)), folder)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
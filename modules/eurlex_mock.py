@@ -0,0 +1,233 @@
+"""
+This file implements a local mock of the EUR-Lex SPARQL endpoint and
+cellar resources used by extract_european_texts, serving responses shaped
+like recorded ones (SPARQL json results, RDF/XML notices, DOC_1 HTML).
+"""
+
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SPARQL_PATH = "/webapi/rdf/sparql"
+RESOURCE_PATH = "/resource"
+# Date of the cellar resources, which are not modified afterwards
+LAST_MODIFIED = "Fri, 01 Oct 2021 08:00:00 GMT"
+
+RDF_NOTICE = """<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+    xmlns:cdm="http://publications.europa.eu/ontology/cdm#"
+    xmlns:owl="http://www.w3.org/2002/07/owl#">
+  <rdf:Description rdf:about="{oj_uri}">
+    <owl:sameAs rdf:resource="{cellar_uri}"/>
+  </rdf:Description>
+  <rdf:Description rdf:about="{cellar_uri}">
+    <cdm:expression_title xml:lang="fr">{title}</cdm:expression_title>
+    <cdm:expression_uses_language rdf:resource="{language_uri}"/>
+    <cdm:expression_belongs_to_work rdf:resource="{work_uri}"/>
+  </rdf:Description>
+</rdf:RDF>
+"""
+
+DOC_HTML = """<!DOCTYPE html>
+<html><head><title>{title}</title></head>
+<body>
+<p class="doc-ti">{title}</p>
+<p class="normal">Le règlement {oj} est applicable aux navires de pêche
+de l'Union opérant dans les eaux de l'Union.</p>
+<p class="normal">Il est obligatoire dans tous ses éléments et directement
+applicable dans tout État membre.</p>
+</body></html>
+"""
+
+
+class MockEurLex:
+    def __init__(
+        self,
+        works_per_day: int = 20,
+        latency: float = 0.0,
+        fail_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        Serves works_per_day works for any day asked for, answering
+        after latency seconds, and a fail_rate fraction of requests 503.
+        Cellar resources have an ETag and a Last-Modified date, and are
+        answered 304 to requests revalidating them.
+        One work in four has no official journal id, one in five has
+        a second language row, and one in four is published in the
+        official journal of the first work of the day before.
+        """
+        self.works_per_day = works_per_day
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.not_modified = 0
+        self.paths = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    def failed(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.fail_rate
+
+    def oj_id(self, date: datetime.date, i: int) -> str:
+        return f"JOL_{date.year}_{date.timetuple().tm_yday:03d}_R_{i:04d}"
+
+    def cellar_uri(self, oj: str) -> str:
+        return f"{self.url}{RESOURCE_PATH}/cellar/{oj.lower()}.0002"
+
+    def work_uri(self, date: datetime.date, i: int) -> str:
+        return f"{self.url}{RESOURCE_PATH}/cellar/{date:%Y%m%d}-{i:04d}"
+
+    def rows(self, date: datetime.date) -> list:
+        """
+        SPARQL result rows of the works of a day.
+        """
+        rows = []
+        for i in range(self.works_per_day):
+            work_ids = f"celex:3{date:%Y%m%d}R{i:04d}"
+            if i % 4 == 2:
+                day_before = date - datetime.timedelta(days=1)
+                work_ids += ",oj:" + self.oj_id(day_before, 0)
+            elif i % 4 != 3:
+                work_ids += ",oj:" + self.oj_id(date, i)
+            for language in ["FRA", "MUL"][: 1 + (i % 5 == 0)]:
+                row = {
+                    "cellarURIs": self.work_uri(date, i),
+                    "title": f"Règlement {date:%Y-%m-%d} n° {i}",
+                    "langIdentifier": language,
+                    "date": f"{date:%Y-%m-%d}",
+                    "subjects": "pêche maritime,pêche durable",
+                    "workIds": work_ids,
+                }
+                rows.append(
+                    {
+                        name: {"type": "literal", "value": value}
+                        for name, value in row.items()
+                    }
+                )
+        return rows
+
+    def sparql(self, query: str) -> dict:
+        """
+        Answers a query of extract_european_texts, rows being ordered by
+        work, date and language as asked for by the query.
+        """
+        start_date, end_date = [
+            datetime.date.fromisoformat(date)
+            for date in re.findall(r'"(\d{4}-\d{2}-\d{2})"\^\^xsd:date', query)
+        ]
+        limit = int(re.search(r"LIMIT (\d+)", query).group(1))
+        offset = int(re.search(r"OFFSET (\d+)", query).group(1))
+        rows = []
+        date = start_date + datetime.timedelta(days=1)
+        while date <= end_date:
+            rows += self.rows(date)
+            date += datetime.timedelta(days=1)
+        rows.sort(
+            key=lambda row: (
+                row["cellarURIs"]["value"],
+                row["date"]["value"],
+                row["langIdentifier"]["value"],
+            )
+        )
+        return {
+            "head": {"vars": list(rows[0]) if rows else []},
+            "results": {"bindings": rows[offset : offset + limit]},
+        }
+
+    def notice(self, oj: str) -> str:
+        return RDF_NOTICE.format(
+            oj_uri=f"{self.url}{RESOURCE_PATH}/oj/{oj}",
+            cellar_uri=self.cellar_uri(oj),
+            work_uri=f"{self.url}{RESOURCE_PATH}/oj/{oj}.work",
+            language_uri=f"{self.url}{RESOURCE_PATH}/authority/language/FRA",
+            title=f"Règlement {oj}",
+        )
+
+    def document(self, oj: str) -> str:
+        return DOC_HTML.format(oj=oj, title=f"Règlement {oj}")
+
+    def start(self):
+        """
+        Serves the endpoint from a background thread, on any free local port.
+        """
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                with mock.lock:
+                    mock.requests += 1
+                    mock.paths.append(url.path)
+                time.sleep(mock.latency)
+                oj = re.fullmatch(
+                    rf"{RESOURCE_PATH}/oj/(\w+)\.FRA", url.path
+                )
+                doc = re.fullmatch(
+                    rf"{RESOURCE_PATH}/cellar/(\w+)\.0002\.03/DOC_1", url.path
+                )
+                if mock.failed():
+                    status, content_type, body = 503, "text/plain", ""
+                elif url.path == SPARQL_PATH:
+                    query = urllib.parse.parse_qs(url.query)["query"][0]
+                    status = 200
+                    content_type = "application/sparql-results+json"
+                    body = json.dumps(mock.sparql(query))
+                elif oj:
+                    status, content_type = 200, "application/rdf+xml"
+                    body = mock.notice(oj.group(1))
+                elif doc:
+                    status, content_type = 200, "text/html; charset=utf-8"
+                    body = mock.document(doc.group(1).upper())
+                else:
+                    status, content_type, body = 404, "text/plain", ""
+                content = body.encode()
+
+                # The SPARQL endpoint sends no validators
+                validators = {}
+                if status == 200 and url.path != SPARQL_PATH:
+                    etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+                    validators = {"ETag": etag, "Last-Modified": LAST_MODIFIED}
+                    if self.headers.get("If-None-Match") == etag or (
+                        self.headers.get("If-None-Match") is None
+                        and self.headers.get("If-Modified-Since")
+                        == LAST_MODIFIED
+                    ):
+                        status, content = 304, b""
+                        with mock.lock:
+                            mock.not_modified += 1
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in validators.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,79 +1,373 @@
+"""
+This file is used to recover texts from the EUR-Lex SPARQL endpoint.
+"""
 import json
 import datetime
+import traceback
+from string import Template
+from xml.sax import SAXException
+import pyarrow as pa
 import requests
 from rdflib import Graph
 from bs4 import BeautifulSoup
-import sys
 import pandas as pd
+import corpus_dataset
+from response_cache import ResponseCache
+from http_client import HttpClient
 
+SPARQL_URL = "http://publications.europa.eu/webapi/rdf/sparql"
+RESOURCE_URL = "http://publications.europa.eu/resource"
+# Harvested documents, a dataset partitioned by date (see corpus_dataset)
+CORPUS_PATH = "C:/Users/karkl/Desktop/NCC/datasets/eurlex"
+# Responses of the endpoint and the cellar kept between runs
+CACHE_PATH = "C:/Users/karkl/Desktop/NCC/datasets/eurlex_cache.sqlite"
+COLUMNS = ["cellar_uri", "date", "title", "topics", "text"]
+SCHEMA = pa.schema([(name, pa.string()) for name in COLUMNS])
+# Number of requests in flight, each with its own pooled connection
+CONCURRENCY = 8
+# Rows asked for by each query, paged through until a shorter page
+PAGE_SIZE = 1000
+# Days covered by each query, the windows being queried concurrently
+WINDOW_DAYS = 1
+# Seconds SPARQL results are cached. They have no validators to revalidate
+# with, and windows ending less than RECENT_DAYS ago are never cached, as
+# works keep being published for them.
+SPARQL_MAX_AGE = 24 * 3600
+RECENT_DAYS = 3
+TIMEOUT = 60
 
-def retrieve_law(url):
-    payload = ""
-    response = requests.request("GET", url, data=payload)
-    if response.status_code == 200:
-        return response.text
-    else:
-        print("ERROR")
-
-
-def call_sparql(start_date, end_date):
-    url = f"http://publications.europa.eu/webapi/rdf/sparql?default-graph-uri=&query=PREFIX+cdm%3A%3Chttp%3A%2F%2Fpublications.europa.eu%2Fontology%2Fcdm%23%3E%0D%0APREFIX+skos%3A%3Chttp%3A%2F%2Fwww.w3.org%2F2004%2F02%2Fskos%2Fcore%23%3E%0D%0APREFIX+dc%3A%3Chttp%3A%2F%2Fpurl.org%2Fdc%2Felements%2F1.1%2F%3E%0D%0APREFIX+xsd%3A%3Chttp%3A%2F%2Fwww.w3.org%2F2001%2FXMLSchema%23%3E%0D%0APREFIX+rdf%3A%3Chttp%3A%2F%2Fwww.w3.org%2F1999%2F02%2F22-rdf-syntax-ns%23%3E%0D%0APREFIX+owl%3A%3Chttp%3A%2F%2Fwww.w3.org%2F2002%2F07%2Fowl%23%3E%0D%0ASELECT+%0D%0ADISTINCT+%28group_concat%28distinct+%3Fwork%3Bseparator%3D%22%2C%22%29+as+%3FcellarURIs%29%0D%0A%28group_concat%28distinct+%3Ftitle_%3Bseparator%3D%22%2C%22%29+as+%3Ftitle%29%0D%0A%3FlangIdentifier%0D%0A%28group_concat%28distinct+%3Fmtype%3Bseparator%3D%22%2C%22%29+as+%3Fmtypes%29%0D%0A%28group_concat%28distinct+%3Fthumbnail%3Bseparator%3D%22%2C%22%29+as+%3Fthumbnails%29+%0D%0A%28group_concat%28distinct+%3FresType%3Bseparator%3D%22%2C%22%29+as+%3FworkTypes%29+%0D%0A%28group_concat%28distinct+%3FagentName%3Bseparator%3D%22%2C%22%29+as+%3Fauthors%29%0D%0A%28group_concat%28distinct+%3FprivateAgentName%3Bseparator%3D%22%3B%22%29+as+%3FprivateAuthors%29%0D%0A%3Fdate%0D%0A%28group_concat%28distinct+%3FsubjectLabel%3Bseparator%3D%22%2C%22%29+as+%3Fsubjects%29%0D%0A%28group_concat%28distinct+%3FworkId_%3Bseparator%3D%22%2C%22%29+as+%3FworkIds%29%0D%0AWHERE+%0D%0A%7B%0D%0A++++%3Fwork+rdf%3Atype+%3FresType+.%0D%0A++++%3Fwork+cdm%3Awork_date_document+%3Fdate+.%0D%0A++++%3Fwork+cdm%3Awork_id_document+%3FworkId_.%0D%0A++++%3Fwork+cdm%3Awork_is_about_concept_eurovoc+%3Fsubject.+graph+%3Fgs+%0D%0A++++%7B+%3Fsubject+skos%3AprefLabel+%3FsubjectLabel++filter+%28lang%28%3FsubjectLabel%29%3D%22fr%22%29+%7D.%0D%0A++++graph+%3Fge+%7B+%0D%0A++++%3Fexp+cdm%3Aexpression_belongs_to_work+%3Fwork+.%0D%0A+++++%3Fexp+cdm%3Aexpression_title+%3Ftitle_+%0D%0Afilter%28lang%28%3Ftitle_%29%3D%22fr%22+or+lang%28%3Ftitle_%29%3D%22fra%22+or+lang%28%3Ftitle_%29%3D%27%27+%29.%0D%0A+++++%3Fexp+cdm%3Aexpression_uses_language+%3Flg.+%0D%0Agraph+%3Flgc+%7B+%3Flg+dc%3Aidentifier+%3FlangIdentifier+.%7D%0D%0A%7D%0D%0A++++graph+%3Fgm+%7B%0D%0A++++%3Fmanif+cdm%3Amanifestation_manifests_expression+%3Fexp+.%0D%0A++++%7B%3Fmanif+cdm%3Amanifestation_type+%3Fmtype+.%7D%0D%0A++++OPTIONAL+%7B%3Fmanif+cdm%3Amanifestation_has_thumbnail+%3Fthumbnail%7D%0D%0A%7D%0D%0A++++OPTIONAL+%7B++++++++graph+%3Fgagent+%7B+%7B%3Fwork+cdm%3Awork_contributed_to_by_agent+%3Fagent+.%7D%0D%0A+++++++++++union+%0D%0A+++++++++++%7B%3Fwork+cdm%3Awork_created_by_agent+%3Fagent+%7D%0D%0A+++++++++++union+%0D%0A+++++++++++%7B%3Fwork+cdm%3Awork_authored_by_agent+%3Fagent+%7D%0D%0A+++++++%7D+++++++graph+%3Fga+%7B+%3Fagent+skos%3AprefLabel+%3FagentName++%0D%0A+++++++++++++++++++++++filter+%28lang%28%3FagentName%29%3D%22fr%22%29+.++++++++++++++++++%7D%7D.%0D%0A++++OPTIONAL+%7Bgraph+%3FpersAuthor+%7B+%7B%3Fwork+cdm%3Awork_contributed_to_by_agent+%3FprivateAgent+.%7D%0D%0A+++++++++++union+%0D%0A+++++++++++%7B%3Fwork+cdm%3Awork_authored_by_agent+%3FprivateAgent+%7D%0D%0A%7D%0D%0A%3FprivateAgent+rdf%3Atype+cdm%3Aperson+.%0D%0A%3FprivateAgent+cdm%3Aagent_name+%3FprivateAgentName+%0D%0A%7D%0D%0A+%7B+SELECT+DISTINCT+%3Fwork+WHERE+%7B+%0D%0A++++%3Fwork+rdf%3Atype+%3FresType+.%0D%0A++++%3Fwork+cdm%3Awork_date_document+%3Fdate+.%0D%0A++++FILTER%28+%3Fdate+%3E+%22{start_date}%22%5E%5Exsd%3Adate+AND+%3Fdate+%3C%3D+%22{end_date}%22%5E%5Exsd%3Adate%29%0D%0A++++%3Fwork+cdm%3Awork_id_document+%3FworkId_.%0D%0A%7D+%0D%0ALIMIT+5000%0D%0A%7D%0D%0A%7D%0D%0AGROUP+BY+%3Fwork++%3Fdate+%3FlangIdentifier%0D%0AOFFSET+0&format=application%2Fsparql-results%2Bjson&timeout=0&debug=on&run=+Run+Query+"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:93.0) Gecko/20100101 Firefox/93.0",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-        "Accept-Language": "fr,fr-FR;q=0.8,en-US;q=0.5,en;q=0.3",
-        "Upgrade-Insecure-Requests": "1",
-        "Pragma": "no-cache",
-        "Cache-Control": "no-cache",
-    }
-    payload = ""
-    response = requests.request("GET", url, data=payload, headers=headers)
-    # print(url)
-
-    if response.status_code == 200:
-        return response.text
-    else:
-        sys.exit(f"Error on file {start_date}_{end_date}")
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:93.0) Gecko/20100101 Firefox/93.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+    "Accept-Language": "fr,fr-FR;q=0.8,en-US;q=0.5,en;q=0.3",
+    "Upgrade-Insecure-Requests": "1",
+    "Pragma": "no-cache",
+    "Cache-Control": "no-cache",
+}
 
+# French works published in ]$start_date, $end_date], with their eurovoc
+# subjects. Rows are ordered so that pages of LIMIT/OFFSET do not overlap.
+SPARQL_QUERY = Template(
+    """PREFIX cdm:<http://publications.europa.eu/ontology/cdm#>
+PREFIX skos:<http://www.w3.org/2004/02/skos/core#>
+PREFIX dc:<http://purl.org/dc/elements/1.1/>
+PREFIX xsd:<http://www.w3.org/2001/XMLSchema#>
+PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX owl:<http://www.w3.org/2002/07/owl#>
+SELECT
+DISTINCT (group_concat(distinct ?work;separator=",") as ?cellarURIs)
+(group_concat(distinct ?title_;separator=",") as ?title)
+?langIdentifier
+(group_concat(distinct ?mtype;separator=",") as ?mtypes)
+(group_concat(distinct ?thumbnail;separator=",") as ?thumbnails)
+(group_concat(distinct ?resType;separator=",") as ?workTypes)
+(group_concat(distinct ?agentName;separator=",") as ?authors)
+(group_concat(distinct ?privateAgentName;separator=";") as ?privateAuthors)
+?date
+(group_concat(distinct ?subjectLabel;separator=",") as ?subjects)
+(group_concat(distinct ?workId_;separator=",") as ?workIds)
+WHERE
+{
+    ?work rdf:type ?resType .
+    ?work cdm:work_date_document ?date .
+    ?work cdm:work_id_document ?workId_.
+    ?work cdm:work_is_about_concept_eurovoc ?subject. graph ?gs
+    { ?subject skos:prefLabel ?subjectLabel  filter (lang(?subjectLabel)="fr") }.
+    graph ?ge {
+    ?exp cdm:expression_belongs_to_work ?work .
+     ?exp cdm:expression_title ?title_
+filter(lang(?title_)="fr" or lang(?title_)="fra" or lang(?title_)='' ).
+     ?exp cdm:expression_uses_language ?lg.
+graph ?lgc { ?lg dc:identifier ?langIdentifier .}
+}
+    graph ?gm {
+    ?manif cdm:manifestation_manifests_expression ?exp .
+    {?manif cdm:manifestation_type ?mtype .}
+    OPTIONAL {?manif cdm:manifestation_has_thumbnail ?thumbnail}
+}
+    OPTIONAL {        graph ?gagent { {?work cdm:work_contributed_to_by_agent ?agent .}
+           union
+           {?work cdm:work_created_by_agent ?agent }
+           union
+           {?work cdm:work_authored_by_agent ?agent }
+       }       graph ?ga { ?agent skos:prefLabel ?agentName
+                       filter (lang(?agentName)="fr") .                  }}.
+    OPTIONAL {graph ?persAuthor { {?work cdm:work_contributed_to_by_agent ?privateAgent .}
+           union
+           {?work cdm:work_authored_by_agent ?privateAgent }
+}
+?privateAgent rdf:type cdm:person .
+?privateAgent cdm:agent_name ?privateAgentName
+}
+ { SELECT DISTINCT ?work WHERE {
+    ?work rdf:type ?resType .
+    ?work cdm:work_date_document ?date .
+    FILTER( ?date > "$start_date"^^xsd:date AND ?date <= "$end_date"^^xsd:date)
+    ?work cdm:work_id_document ?workId_.
+}
+}
+}
+GROUP BY ?work  ?date ?langIdentifier
+ORDER BY ?work ?date ?langIdentifier
+LIMIT $limit
+OFFSET $offset"""
+)
 
-if __name__ == "__main__":
-    start_date = datetime.datetime(2021, 9, 1)
-    end_date = datetime.datetime(2021, 10, 16)
-    name_end = end_date
-    df = pd.DataFrame(columns=[])
+
+class EurLexClient(HttpClient):
+    def __init__(
+        self,
+        sparql_url: str = SPARQL_URL,
+        resource_url: str = RESOURCE_URL,
+        concurrency: int = CONCURRENCY,
+        cache: ResponseCache = None,
+    ):
+        """
+        Keep-alive session on the SPARQL endpoint and the cellar,
+        shared by concurrency threads, answered from cache when given.
+        """
+        super().__init__(concurrency, pool_connections=2)
+        self.sparql_url = sparql_url
+        self.resource_url = resource_url
+        self.cache = cache
+
+    def get(
+        self,
+        url: str,
+        params: dict = None,
+        headers: dict = None,
+        max_age: float = None,
+    ) -> str:
+        """
+        Returns the text answering a GET of url. Cached responses are
+        returned while fresh (for at most max_age seconds when given),
+        and revalidated with their ETag and Last-Modified once stale.
+        A max_age of 0 bypasses the cache.
+        """
+        if self.cache is None or max_age == 0:
+            r = self.request(url, params, headers)
+            r.raise_for_status()
+            return r.text
+
+        headers = dict(headers or {})
+        # Notices are negotiated on Accept
+        key = (
+            requests.Request("GET", url, params=params).prepare().url
+            + "\n"
+            + headers.get("Accept", "")
+        )
+        cached = self.cache.lookup(key, max_age)
+        if cached is not None:
+            body, etag, last_modified, fresh = cached
+            if fresh:
+                return body
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
+        r = self.request(url, params, headers)
+        if r.status_code == 304 and cached is not None:
+            self.cache.revalidated(key)
+            return body
+        r.raise_for_status()
+        if "no-store" not in r.headers.get("Cache-Control", ""):
+            self.cache.store(
+                key,
+                r.text,
+                r.headers.get("ETag"),
+                r.headers.get("Last-Modified"),
+            )
+        return r.text
+
+    def request(self, url: str, params=None, headers=None):
+        """
+        Sends a GET of url, 429/5xx answers and connection errors
+        being retried with backoff (see HttpClient.send).
+        """
+        return self.send(
+            lambda: self.session.get(
+                url, params=params, headers=headers, timeout=TIMEOUT
+            )
+        )
+
+
+def date_windows(start_date, end_date, days: int = WINDOW_DAYS) -> list:
+    """
+    Splits ]start_date, end_date] into windows of days, newest first,
+    as (start, end) pairs of YYYY-MM-DD dates.
+    """
+    windows = []
     while end_date > start_date:
-        day_before = end_date - datetime.timedelta(days=1)
+        window_start = max(end_date - datetime.timedelta(days=days), start_date)
+        windows.append(
+            (window_start.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+        )
+        end_date = window_start
+    return windows
+
+
+def call_sparql(window: tuple, client: EurLexClient, page_size=PAGE_SIZE):
+    """
+    Returns all the result rows of the works published in a
+    (start_date, end_date) window, paging through OFFSET.
+    """
+    start_date, end_date = window
+    recent = datetime.date.today() - datetime.timedelta(days=RECENT_DAYS)
+    if datetime.date.fromisoformat(end_date) >= recent:
+        max_age = 0
+    else:
+        max_age = SPARQL_MAX_AGE
+    bindings = []
+    while True:
+        query = SPARQL_QUERY.substitute(
+            start_date=start_date,
+            end_date=end_date,
+            limit=page_size,
+            offset=len(bindings),
+        )
         data = json.loads(
-            call_sparql(
-                f"{day_before.strftime('%Y-%m-%d')}",
-                f"{end_date.strftime('%Y-%m-%d')}",
+            client.get(
+                client.sparql_url,
+                params={
+                    "default-graph-uri": "",
+                    "query": query,
+                    "format": "application/sparql-results+json",
+                    "timeout": 0,
+                },
+                headers=HEADERS,
+                max_age=max_age,
             )
         )
-        for i, j in enumerate(data["results"]["bindings"]):
-            if "oj:" in (j.get("workIds").get("value")):
-                oj = (
-                    j.get("workIds").get("value").split("oj:")[1].split(",")[0]
-                )
-                g = Graph()
-                g.parse(f"http://publications.europa.eu/resource/oj/{oj}.FRA")
-                for s, p, o in g:
-                    if "cellar" in str(s):
-                        text_url = f"{s}.03/DOC_1"
-                        soup = BeautifulSoup(
-                            retrieve_law(text_url), features="html.parser"
-                        )
-                        # print(j['title']['value'])
-                        df = df.append(
-                            {
-                                "title": j["title"]["value"],
-                                "topics": j["subjects"]["value"],
-                                "date": j["date"]["value"],
-                                "text": str(soup.get_text()),
-                            },
-                            ignore_index=True,
-                        )
-        end_date -= datetime.timedelta(days=1)
-        df.to_csv(
-            f'{start_date.strftime("%Y-%m-%d")}_{name_end.strftime("%Y-%m-%d")}.csv',
-            index=False,
+        page = data["results"]["bindings"]
+        bindings += page
+        if len(page) < page_size:
+            return bindings
+
+
+def get_oj_id(binding: dict):
+    """
+    Returns the official journal id of a result row, None if it has none.
+    """
+    work_ids = binding["workIds"]["value"]
+    if "oj:" not in work_ids:
+        return None
+    return work_ids.split("oj:")[1].split(",")[0]
+
+
+def get_cellar_uris(oj: str, client: EurLexClient) -> list:
+    """
+    Returns the cellar resources described by the notice of an official
+    journal id, each once, or an empty list if it could not be fetched.
+    """
+    try:
+        notice = client.get(
+            f"{client.resource_url}/oj/{oj}.FRA",
+            headers={"Accept": "application/rdf+xml"},
+        )
+        g = Graph()
+        g.parse(data=notice, format="xml")
+    except (requests.RequestException, SAXException):
+        traceback.print_exc()
+        return []
+    subjects = [str(s) for s in g.subjects()]
+    return list(dict.fromkeys(s for s in subjects if "cellar" in s))
+
+
+def retrieve_law(url: str, client: EurLexClient):
+    """
+    Returns the raw text of the html document at url,
+    None if it could not be fetched.
+    """
+    try:
+        html = client.get(url)
+    except requests.RequestException:
+        print(f"ERROR {url}")
+        return None
+    return str(BeautifulSoup(html, features="html.parser").get_text())
+
+
+def harvest(
+    client: EurLexClient,
+    start_date,
+    end_date,
+    seen: set = None,
+    page_size: int = PAGE_SIZE,
+):
+    """
+    Yields the documents of each date window of ]start_date, end_date],
+    newest first, as lists of records (title, topics, date, text,
+    cellar_uri). Windows are queried concurrently, notices and texts
+    fetched concurrently. Cellar resources in seen, or already yielded,
+    are skipped.
+    """
+    seen = set() if seen is None else seen
+    resolved = {}
+    windows = date_windows(start_date, end_date)
+    for bindings in client.map(
+        lambda window, client: call_sparql(window, client, page_size), windows
+    ):
+        # Several rows (and days) may share an official journal
+        ojs = [get_oj_id(binding) for binding in bindings]
+        new_ojs = list(
+            dict.fromkeys(
+                oj for oj in ojs if oj is not None and oj not in resolved
+            )
+        )
+        resolved.update(zip(new_ojs, client.map(get_cellar_uris, new_ojs)))
+
+        documents = []
+        for binding, oj in zip(bindings, ojs):
+            for cellar_uri in resolved.get(oj, []):
+                if cellar_uri not in seen:
+                    seen.add(cellar_uri)
+                    documents.append((binding, cellar_uri))
+        texts = client.map(
+            retrieve_law, [f"{uri}.03/DOC_1" for _, uri in documents]
         )
+
+        records = []
+        for (binding, cellar_uri), text in zip(documents, texts):
+            if text is None:
+                # Left to a later harvest
+                seen.discard(cellar_uri)
+                continue
+            records.append(
+                {
+                    "title": binding["title"]["value"],
+                    "topics": binding["subjects"]["value"],
+                    "date": binding["date"]["value"],
+                    "text": text,
+                    "cellar_uri": cellar_uri,
+                }
+            )
+        yield records
+
+
+def harvest_to_corpus(
+    client: EurLexClient, start_date, end_date, corpus_path=CORPUS_PATH
+) -> int:
+    """
+    Appends the documents of ]start_date, end_date] to the corpus dataset
+    by batches, skipping the ones it already stores, then compacts the
+    files of each date.
+
+    Returns:
+        int: number of documents added
+    """
+    seen = corpus_dataset.read_ids(corpus_path, "cellar_uri")
+    added = 0
+    with corpus_dataset.CorpusWriter(corpus_path, schema=SCHEMA) as writer:
+        for records in harvest(client, start_date, end_date, seen):
+            writer.append(pd.DataFrame.from_records(records, columns=COLUMNS))
+            added += len(records)
+    if added > 0:
+        corpus_dataset.compact(corpus_path, key="cellar_uri")
+    return added
+
+
+if __name__ == "__main__":
+    start_date = datetime.datetime(2021, 9, 1)
+    end_date = datetime.datetime(2021, 10, 16)
+    client = EurLexClient(cache=ResponseCache(CACHE_PATH))
+    print(f"{harvest_to_corpus(client, start_date, end_date)} texts added")
@@ -1,25 +1,57 @@
 """
 This file is used to recover texts from the LEGIFRANCE API.
 """
+import json
 import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
 import requests
+import corpus_dataset
 import pandas as pd
 from tqdm import tqdm
 from bs4 import BeautifulSoup
+from html import unescape
+from html.entities import name2codepoint
+from http_client import HttpClient
 
 CLIENT_ID = ""
 CLIENT_SECRET = ""
 
 API_URL = "https://api.piste.gouv.fr/dila/legifrance-beta/lf-engine-app"
 TOKEN_URL = "https://oauth.piste.gouv.fr/api/oauth/token"
-
-
-def get_token():
+# Corpus read by the topic finder pipeline (see __main__.py)
+CORPUS_PATH = "C:/Users/karkl/Desktop/NCC/datasets/legifrance"
+# Journals asked for first by a sync, doubled until reaching synced ones
+SYNC_WINDOW = 8
+# Number of texts fetched between two writes of the corpus
+SYNC_CHUNK = 1000
+# Answers of /consult/jorf kept to check the text extraction against
+RESPONSES_PATH = "C:/Users/karkl/Desktop/NCC/datasets/legifrance_responses"
+# Number of corpus texts whose answers are checked
+CHECK_SAMPLE = 500
+# Parse article HTML once, only set once check_extraction (run as
+# `python extract_legipeche.py check`) found no difference on real texts
+FAST_EXTRACTION = False
+# Number of requests in flight, each with its own pooled connection
+CONCURRENCY = 16
+# Maximum number of requests per second sent to the API
+RATE_LIMIT = 20.0
+# Seconds before its expiry a token is replaced
+TOKEN_MARGIN = 60
+TIMEOUT = 60
+
+
+def get_token(token_url: str = TOKEN_URL) -> dict:
     """
-    Format token for LEGIFRANCE.
+    Requests a token for LEGIFRANCE, returns the answer of the
+    authentication server (access_token, expires_in in seconds).
     """
     token = requests.post(
-        TOKEN_URL,
+        token_url,
         headers={
             "Content-Type": "application/x-www-form-urlencoded",
         },
@@ -29,52 +61,124 @@ def get_token():
             "client_id": CLIENT_ID,
             "client_secret": CLIENT_SECRET,
         },
+        timeout=TIMEOUT,
     )
-    print(token.json())
-    return token.json()["access_token"]
+    token.raise_for_status()
+    return token.json()
+
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        """
+        Spaces calls to wait() by 1 / rate seconds, across threads.
+        """
+        self.interval = 1 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        time.sleep(slot - now)
+
+
+class LegifranceClient(HttpClient):
+    def __init__(
+        self,
+        fetch_token=get_token,
+        api_url: str = API_URL,
+        concurrency: int = CONCURRENCY,
+        rate_limit: float = RATE_LIMIT,
+    ):
+        """
+        Keep-alive session on the API, shared by concurrency threads
+        sending at most rate_limit requests per second.
+        Tokens come from fetch_token (see get_token) and are replaced
+        TOKEN_MARGIN seconds before they expire.
+        """
+        super().__init__(concurrency)
+        self.api_url = api_url
+        self.rate_limiter = RateLimiter(rate_limit)
+
+        self.fetch_token = fetch_token
+        self.token = None
+        self.token_expiry = 0.0
+        self.token_lock = threading.Lock()
+
+    def authorization(self, expired: str = None) -> str:
+        """
+        Returns the current token, refreshed when close to its expiry
+        or when it is the expired one rejected by the API.
+        """
+        with self.token_lock:
+            if (
+                self.token is None
+                or self.token == expired
+                or time.monotonic() > self.token_expiry - TOKEN_MARGIN
+            ):
+                token = self.fetch_token()
+                self.token = token["access_token"]
+                self.token_expiry = time.monotonic() + float(
+                    token.get("expires_in", 3600)
+                )
+            return self.token
+
+    def post(self, endpoint: str, payload: dict) -> dict:
+        """
+        Posts payload to an endpoint of the API, returns the json answer.
+        A rejected token is refreshed once, 429/5xx answers and connection
+        errors retried with backoff (see HttpClient.send).
+        """
+
+        def request():
+            self.rate_limiter.wait()
+            return self.session.post(
+                self.api_url + endpoint,
+                json=payload,
+                headers={"Authorization": "Bearer " + token},
+                timeout=TIMEOUT,
+            )
+
+        token = self.authorization()
+        r = self.send(request)
+        if r.status_code == 401:
+            token = self.authorization(expired=token)
+            r = self.send(request)
+        r.raise_for_status()
+        return r.json()
 
 
-def get_last_n_jorf_cont_id(n: int, token) -> pd.DataFrame:
+def get_last_n_jorf_cont_id(n: int, client: LegifranceClient) -> pd.DataFrame:
     """Extract the ids of the official journal for the last n-days.
 
     Args:
         n (int): Number of days
-        token ([type]): API token
+        client (LegifranceClient): API session
 
     Returns:
         pd.DataFrame: List of ids of official journals of the last n days.
     """
-    url = API_URL + "/consult/lastNJo"
-    headers = {
-        "Authorization": "Bearer " + token,
-    }
-    r = requests.post(url, headers=headers, json={"nbElement": n})
-    r.raise_for_status()
-    return pd.DataFrame.from_records(r.json()["containers"])
+    data = client.post("/consult/lastNJo", {"nbElement": n})
+    return pd.DataFrame.from_records(data["containers"])
 
 
-def get_jorf_cont(jorf_cont_id: str, token) -> dict:
+def get_jorf_cont(jorf_cont_id: str, client: LegifranceClient) -> dict:
     """Fetches the content of an official journal
 
     Args:
         jorf_cont_id (str): id of an official journal
-        token ([type]): API token
+        client (LegifranceClient): API session
 
     Returns:
         dict: structured data of the content of an official journal
     """
-    url = API_URL + "/consult/jorfCont"
-    headers = {"Authorization": "Bearer " + token}
-
-    r = requests.post(
-        url,
-        headers=headers,
-        json={"id": jorf_cont_id, "pageNumber": 1, "pageSize": 1},
+    data = client.post(
+        "/consult/jorfCont",
+        {"id": jorf_cont_id, "pageNumber": 1, "pageSize": 1},
     )
-
-    r.raise_for_status()
-    data = r.json()["items"][0]["joCont"]["structure"]
-    return data
+    return data["items"][0]["joCont"]["structure"]
 
 
 def extract_text_ids_from_jorf_cont(jorf_cont: dict) -> list:
@@ -121,63 +225,67 @@ def extract_text_ids_from_jorf_cont(jorf_cont: dict) -> list:
 
 
 def get_text_list(
-    n_jorf: int, token: str, output_filename: str = "textes.csv"
+    n_jorf: int,
+    client: LegifranceClient,
+    output_filename: str = "textes.csv",
 ):
     """
     Extracts the list of all texts published over the last `n_jorf` days,
-    saves the result as csv.
+    saves the result as csv. Journals are fetched concurrently.
 
     Args:
         n_jorf (int): Number of days to extract
-        token (str): API token
+        client (LegifranceClient): API session
         output_filename (str, optional): csv filename to save results to.
         Defaults to "textes.csv".
     """
-    jorf_cont_ids = get_last_n_jorf_cont_id(n_jorf, token)
+    jorf_cont_ids = get_last_n_jorf_cont_id(n_jorf, client)
     dfs = []
-    for jorf_cont_id in tqdm(jorf_cont_ids["id"]):
+    for jorf_cont in tqdm(
+        client.map(get_jorf_cont, jorf_cont_ids["id"]),
+        total=len(jorf_cont_ids),
+    ):
         dfs.append(
             pd.DataFrame.from_records(
-                extract_text_ids_from_jorf_cont(
-                    get_jorf_cont(jorf_cont_id, token)
-                )
+                extract_text_ids_from_jorf_cont(jorf_cont)
             )
         )
     res = pd.concat(dfs)
     res.to_csv(output_filename, index=False)
 
 
-def get_text(id: str, token: str) -> dict:
+def get_text(id: str, client: LegifranceClient) -> dict:
     """
     Fetches a text from its id,
     returns the structured object returned by the API.
 
     Args:
         id (str): text id
-        token (str): API token
+        client (LegifranceClient): API session
 
     Returns:
         dict: Structured object with the content of the text
     """
-    url = API_URL + "/consult/jorf"
-    headers = {"Authorization": "Bearer " + token}
+    return client.post("/consult/jorf", {"textCid": id})
 
-    r = requests.post(
-        url,
-        headers=headers,
-        json={
-            "textCid": id,
-        },
-    )
 
-    r.raise_for_status()
-    data = r.json()
-    return data
+def fetch_text_content(id: str, client: LegifranceClient):
+    """
+    Returns the raw text of a text id, None if it could not be fetched.
+    """
+    try:
+        return extract_content_from_text(get_text(id, client), id)
+    except (requests.RequestException, KeyError, ValueError):
+        traceback.print_exc()
+        return None
 
 
 def extract_content_from_text(text: dict, textid: str) -> str:
     """Extracts raw text from structured text object.
 
+    With FAST_EXTRACTION, texts whose article HTML is in the subset
+    fast_extract_content_from_text supports are parsed once.
+
     Args:
         text (dict): Structured text object returned by the API
         textid (str): text id
@@ -185,6 +293,18 @@ def extract_content_from_text(text: dict, textid: str) -> str:
     Returns:
         str: human readable text contained in the text object.
     """
+    if FAST_EXTRACTION:
+        content = fast_extract_content_from_text(text)
+        if content is not None:
+            return content
+    return legacy_extract_content_from_text(text, textid)
+
+
+def legacy_extract_content_from_text(text: dict, textid: str) -> str:
+    """
+    Reference implementation of extract_content_from_text, parsing
+    the text of each section again at every ancestor level.
+    """
     content = []
 
     if text["articles"]:
@@ -198,7 +318,9 @@ def extract_content_from_text(text: dict, textid: str) -> str:
 
     if "sections" in text:
         for section in text["sections"]:
-            section_content = extract_content_from_text(section, textid)
+            section_content = legacy_extract_content_from_text(
+                section, textid
+            )
             content.append(
                 {"int_ordre": section["intOrdre"], "content": section_content}
             )
@@ -211,36 +333,323 @@ def extract_content_from_text(text: dict, textid: str) -> str:
     return res
 
 
+def save_responses(
+    client: LegifranceClient, ids: list, folder: str = RESPONSES_PATH
+) -> int:
+    """
+    Saves the answers of /consult/jorf for the text ids as <id>.json
+    files in folder, skipping the ones already saved.
+
+    Returns:
+        int: number of answers saved
+    """
+    os.makedirs(folder, exist_ok=True)
+    ids = [
+        id
+        for id in ids
+        if not os.path.exists(os.path.join(folder, id + ".json"))
+    ]
+
+    def fetch(id, client):
+        try:
+            return get_text(id, client)
+        except (requests.RequestException, ValueError):
+            traceback.print_exc()
+            return None
+
+    saved = 0
+    for id, text in zip(ids, client.map(fetch, ids)):
+        if text is not None:
+            path = os.path.join(folder, id + ".json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(text, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+            saved += 1
+    return saved
+
+
+def check_extraction(folder: str = RESPONSES_PATH) -> dict:
+    """
+    Golden comparison of fast_extract_content_from_text with
+    legacy_extract_content_from_text on the answers saved in folder.
+
+    Returns:
+        dict: number of texts checked, ids of the texts extracted
+        differently and of the ones left to the legacy extraction
+    """
+    result = {"checked": 0, "different": [], "legacy": []}
+    for file_name in sorted(os.listdir(folder)):
+        if not file_name.endswith(".json"):
+            continue
+        id = file_name[: -len(".json")]
+        with open(os.path.join(folder, file_name), encoding="utf-8") as f:
+            text = json.load(f)
+        result["checked"] += 1
+        expected = legacy_extract_content_from_text(text, id)
+        found = fast_extract_content_from_text(text)
+        if found is None:
+            result["legacy"].append(id)
+        elif found != expected:
+            result["different"].append(id)
+    return result
+
+
+class _Unsupported(Exception):
+    """
+    HTML outside the subset fast_extract_content_from_text supports.
+    """
+
+
+# Elements whose strings BeautifulSoup keeps as html.parser reads them
+FAST_TAGS = set(
+    "a b big blockquote br caption center col colgroup dd div dl dt em "
+    "font h1 h2 h3 h4 h5 h6 hr i img li ol p s small span strike strong "
+    "sub sup table tbody td tfoot th thead tr u ul".split()
+)
+# Start, self-closing or end tag, attribute values without markup
+TAG = re.compile(
+    r"<(?:([a-zA-Z][a-zA-Z0-9]*)"
+    r"(?:[ \t\n\f]+[a-zA-Z][a-zA-Z0-9-]*(?:[ \t\n\f]*=[ \t\n\f]*"
+    r"(?:\"[^\"<>&]*\"|'[^'<>&]*'|[a-zA-Z0-9-]+))?)*"
+    r"[ \t\n\f]*/?|/([a-zA-Z][a-zA-Z0-9]*)[ \t\n\f]*)>"
+)
+# Character reference ended by its semicolon
+REFERENCE = re.compile(r"&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);")
+# Whitespace BeautifulSoup reduces to a single space or newline
+ASCII_SPACES = " \n\t\f\r"
+
+
+def _collect_articles(text: dict, articles: list) -> list:
+    """
+    Appends the HTML of the articles of a text and its sections,
+    in the order _level_strings reads them.
+    """
+    if text["articles"]:
+        articles.extend(article["content"] for article in text["articles"])
+    for section in text.get("sections", []):
+        _collect_articles(section, articles)
+    return articles
+
+
+def _article_strings(html: str) -> list:
+    """
+    Returns the strings html.parser reads in the HTML of an article,
+    whitespace left as is. Supported articles are made of FAST_TAGS tags
+    and text where every "&" starts a complete HTML 4 character reference
+    (decoded alike by BeautifulSoup and unescape): no "<" or "&" left
+    for the next article to complete.
+    """
+    if "\r" in html:
+        raise _Unsupported
+    strings = []
+    position = 0
+    for tag in TAG.finditer(html):
+        if (tag.group(1) or tag.group(2)).lower() not in FAST_TAGS:
+            raise _Unsupported
+        strings.append(html[position : tag.start()])
+        position = tag.end()
+    strings.append(html[position:])
+    for string in strings:
+        references = REFERENCE.findall(string)
+        if "<" in string or ">" in string or string.count("&") != len(
+            references
+        ):
+            raise _Unsupported
+        for reference in references:
+            if reference[0] != "#":
+                code = name2codepoint.get(reference, 0)
+            elif reference[1] in "xX":
+                code = int(reference[2:], 16)
+            else:
+                code = int(reference[1:])
+            if not (32 <= code < 127 or 160 <= code < 0xD800):
+                raise _Unsupported
+    return [unescape(string) for string in strings if string]
+
+
+def _normalize_whitespace(string: str) -> str:
+    """
+    Whitespace only strings, as kept by BeautifulSoup.
+    """
+    if string.strip(ASCII_SPACES):
+        return string
+    return "\n" if "\n" in string else " "
+
+
+def _level_strings(text: dict, article_strings) -> list:
+    """
+    Returns the strings get_text joins for a text or section: article
+    strings (next ones from article_strings) and, for each subsection,
+    its text as a single string.
+    Strings of consecutive items merge when no tag separates them,
+    as they do once concatenated as HTML.
+    """
+    content = []
+    if text["articles"]:
+        for article in text["articles"]:
+            content.append(
+                (
+                    article["intOrdre"],
+                    article["content"],
+                    next(article_strings),
+                )
+            )
+    if "sections" in text:
+        for section in text["sections"]:
+            section_content = "\n".join(
+                _level_strings(section, article_strings)
+            )
+            # Section text is parsed as HTML by its parent level
+            if "<" in section_content or "&" in section_content:
+                raise _Unsupported
+            content.append((section["intOrdre"], section_content, None))
+    content = sorted(content, key=lambda x: x[0])
+
+    strings = []
+    ends_with_text = False
+    for _, html, fragment in content:
+        if not html:
+            continue
+        is_text = fragment is None
+        if is_text:
+            fragment = [html]
+            starts_with_text = True
+        else:
+            fragment = list(fragment)
+            starts_with_text = not html.startswith("<")
+        if starts_with_text and ends_with_text and fragment:
+            strings[-1] += fragment.pop(0)
+        strings.extend(fragment)
+        ends_with_text = is_text or not html.endswith(">")
+    return [_normalize_whitespace(s) for s in strings]
+
+
+def fast_extract_content_from_text(text: dict):
+    """
+    extract_content_from_text parsing each article once, then joining
+    the strings of each level as legacy_extract_content_from_text does.
+    Returns None for texts outside the supported subset of HTML.
+    """
+    try:
+        articles = _collect_articles(text, [])
+        strings = iter([_article_strings(html) for html in articles])
+        return "\n".join(_level_strings(text, strings))
+    except _Unsupported:
+        return None
+
+
 def write_to_file(jorf_text_content, folder_path, file_name):
     with open(os.path.join(folder_path, file_name), "w") as f:
         f.write(jorf_text_content)
         return file_name
 
 
-if __name__ == "__main__":
-
-    output_folder_path = "full_texts"
-    csv_file_name = "textes.csv"
+def get_new_jorf_conts(
+    client: LegifranceClient, synced: set, n_jorf: int
+) -> pd.DataFrame:
+    """
+    Returns the official journals of the last `n_jorf` days not synced yet,
+    asking for the last SYNC_WINDOW journals first, then twice as many
+    until reaching synced ones.
+    """
+    n = SYNC_WINDOW if synced else n_jorf
+    while True:
+        containers = get_last_n_jorf_cont_id(min(n, n_jorf), client)
+        if (
+            n >= n_jorf
+            or len(containers) < n
+            or containers["id"].isin(synced).any()
+        ):
+            return containers[~containers["id"].isin(synced)]
+        n *= 2
+
+
+def sync_corpus(
+    client: LegifranceClient, corpus_path: str = CORPUS_PATH, n_jorf=365
+) -> int:
+    """
+    Adds to the corpus dataset the texts of the official journals
+    published since the last sync (over the last `n_jorf` days at most),
+    skipping the texts it already stores. Texts are appended every
+    SYNC_CHUNK texts, so an interrupted sync resumes where it stopped.
+    Journals are remembered as synced once all their texts are stored,
+    the others as incomplete, listed again by every sync until they are.
 
-    print("Getting token")
-    token = get_token()
-    # Extract list of texts for the last 365 days
+    Returns:
+        int: number of texts added
+    """
+    state_path = corpus_path + ".sync.json"
+    state = {"containers": [], "incomplete": {}}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state.update(json.load(f))
+    synced = set(state["containers"])
+    stored = corpus_dataset.read_ids(corpus_path)
+
+    # Texts listed by the new and incomplete journals, with their
+    # publication date (saved for incomplete ones, whatever the window)
+    containers = pd.concat(
+        [
+            get_new_jorf_conts(
+                client, synced | set(state["incomplete"]), n_jorf
+            ),
+            pd.DataFrame(
+                state["incomplete"].items(), columns=["id", "dateParution"]
+            ),
+        ]
+    )
+    dfs = [pd.DataFrame(columns=corpus_dataset.COLUMNS[:-1])]
+    for (jorf_cont_id, date), jorf_cont in zip(
+        containers[["id", "dateParution"]].itertuples(index=False),
+        client.map(get_jorf_cont, containers["id"]),
+    ):
+        df = pd.DataFrame.from_records(
+            extract_text_ids_from_jorf_cont(jorf_cont),
+            columns=["id", "emetteur", "nature", "titre"],
+        )
+        df["jorf_cont_id"] = jorf_cont_id
+        df["date"] = pd.Timestamp(date, unit="ms").strftime("%Y-%m-%d")
+        dfs.append(df)
+    texts = pd.concat(dfs).drop_duplicates("id")
+    texts = texts[~texts["id"].isin(stored)]
+
+    incomplete = {}
+    dates = dict(zip(containers["id"], containers["dateParution"]))
+    added = 0
+    with corpus_dataset.CorpusWriter(corpus_path, SYNC_CHUNK) as writer:
+        for start in tqdm(range(0, len(texts), SYNC_CHUNK)):
+            chunk = texts.iloc[start : start + SYNC_CHUNK].copy()
+            chunk["text"] = list(client.map(fetch_text_content, chunk["id"]))
+            failed = chunk["text"].isna()
+            for jorf_cont_id in chunk.loc[failed, "jorf_cont_id"]:
+                incomplete[jorf_cont_id] = int(dates[jorf_cont_id])
+            writer.append(chunk[~failed])
+            added += (~failed).sum()
+
+    synced |= set(containers["id"]) - set(incomplete)
+    # Written aside then moved, a crash never leaving a partial state
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(
+            {"containers": sorted(synced), "incomplete": incomplete}, f
+        )
+    os.replace(state_path + ".tmp", state_path)
+    return added
 
-    print("Getting text list")
-    get_text_list(2, token, output_filename=csv_file_name)
 
-    print("Reading text list")
-    df = pd.read_csv(csv_file_name)
+if __name__ == "__main__":
 
-    print("Fetching texts and writing to disk")
-    for jorf_text_id in tqdm(df["id"]):
-        try:
-            jorf_text_content = extract_content_from_text(
-                get_text(jorf_text_id, token=token), jorf_text_id
-            )
-        # TODO: which exceptions?
-        except:
-            token = get_token()
-        write_to_file(
-            jorf_text_content, output_folder_path, jorf_text_id + ".txt"
+    client = LegifranceClient()
+    if sys.argv[1:2] == ["check"]:
+        # Checks the extraction of texts sampled from the corpus
+        ids = sorted(corpus_dataset.read_ids(CORPUS_PATH))
+        ids = random.Random(0).sample(ids, min(CHECK_SAMPLE, len(ids)))
+        save_responses(client, ids)
+        result = check_extraction()
+        print(
+            f"{result['checked']} texts checked, "
+            f"{len(result['different'])} extracted differently, "
+            f"{len(result['legacy'])} left to the legacy extraction"
         )
+    else:
+        # Syncs the texts of the last 365 days into the corpus
+        print(f"{sync_corpus(client)} texts added")
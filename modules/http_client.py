@@ -0,0 +1,76 @@
+"""
+This file implements the retries and concurrency shared by the clients
+of the Légifrance and EUR-Lex APIs.
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Retries of a request answered 429/5xx or failing to connect
+MAX_RETRIES = 6
+# First and longest waits between retries, in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def backoff(attempt: int, retry_after=None) -> float:
+    """
+    Seconds to wait before retry number attempt (from 0): the Retry-After
+    of the server if any, else an exponential backoff with jitter.
+    """
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0.5, 1) * min(BACKOFF_BASE * 2**attempt, BACKOFF_MAX)
+
+
+class HttpClient:
+    def __init__(self, concurrency: int, pool_connections: int = 1):
+        """
+        Keep-alive session shared by concurrency threads, with a pooled
+        connection per thread to each of pool_connections hosts.
+        """
+        self.concurrency = concurrency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=concurrency
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def send(self, request) -> requests.Response:
+        """
+        Returns the response of request(), 429/5xx answers and connection
+        errors being retried MAX_RETRIES times with backoff.
+        """
+        attempt = 0
+        while True:
+            try:
+                r = request()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(backoff(attempt))
+                attempt += 1
+                continue
+
+            if r.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                time.sleep(backoff(attempt, r.headers.get("Retry-After")))
+                attempt += 1
+            else:
+                return r
+
+    def map(self, function, items):
+        """
+        Yields function(item, self) for each item, in order,
+        computed by concurrency threads.
+        """
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            yield from pool.map(lambda item: function(item, self), items)
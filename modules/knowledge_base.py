@@ -0,0 +1,101 @@
+"""
+This file compiles the keyword/topic sheet into a serialized knowledge base,
+rebuilt only when the sheet or the preprocessing changes.
+"""
+
+import hashlib
+import os
+import pickle
+
+import pandas as pd
+import spacy
+import spacy.util
+
+import preprocessing_utils as utils
+from topicfinder import TopicFinder
+
+# Bumped when the layout of the compiled knowledge base changes
+KNOWLEDGE_BASE_VERSION = "1"
+SPACY_MODEL = "fr_core_news_sm"
+
+
+def source_hash(path: str) -> str:
+    """
+    Hash of the content of the keyword/topic sheet.
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def build_key(path: str) -> dict:
+    """
+    Everything a compiled knowledge base depends on: the sheet,
+    the normalizer and the version of the spaCy model.
+    """
+    return {
+        "version": KNOWLEDGE_BASE_VERSION,
+        "source_hash": source_hash(path),
+        "preprocessing": utils.preprocessing_fingerprint(),
+        "model": spacy.util.get_package_version(SPACY_MODEL),
+    }
+
+
+class KnowledgeBase:
+    def __init__(self, keywords_topics: pd.DataFrame, key: dict):
+        """
+        Normalized keywords grouped by topic, as a ["topic", "words"] table,
+        and their topic finder (keyword index and phrase automaton).
+        """
+        self.keywords_topics = keywords_topics
+        self.topic_finder = TopicFinder(keywords_topics, match_phrases=True)
+        self.topics = self.topic_finder.topics
+        self.key = key
+
+
+def compile_sheet(path: str, nlp) -> KnowledgeBase:
+    """
+    Reads the keyword/topic sheet, one column per topic,
+    and normalizes its keywords as documents are.
+    """
+    keywords_topics = pd.read_excel(path)
+    keywords_topics = pd.DataFrame(
+        keywords_topics.stack().dropna().droplevel(0), columns=["words"]
+    )
+    keywords_topics["words"] = utils.preprocess_corpus(
+        nlp, keywords_topics["words"]
+    )
+    keywords_topics = keywords_topics.reset_index().rename(
+        columns={"index": "topic"}
+    )
+    keywords_topics = (
+        keywords_topics.groupby(["topic"])
+        .agg({"words": lambda x: list(x)})
+        .reset_index()
+    )
+    return KnowledgeBase(keywords_topics, build_key(path))
+
+
+def load(path: str, compiled_path: str, nlp=None) -> KnowledgeBase:
+    """
+    Returns the knowledge base compiled from the sheet at path, read from
+    compiled_path when still up to date, else compiled and saved there.
+    spaCy is only loaded (unless given as nlp) to compile.
+    """
+    key = build_key(path)
+    try:
+        with open(compiled_path, "rb") as f:
+            knowledge_base = pickle.load(f)
+        if knowledge_base.key == key:
+            return knowledge_base
+    except Exception:
+        # Missing, truncated, or pickled by code that changed since
+        pass
+
+    if nlp is None:
+        nlp = spacy.load(SPACY_MODEL)
+    knowledge_base = compile_sheet(path, nlp)
+    # Written aside then moved, never leaving a partial file
+    with open(compiled_path + ".tmp", "wb") as f:
+        pickle.dump(knowledge_base, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(compiled_path + ".tmp", compiled_path)
+    return knowledge_base
@@ -0,0 +1,166 @@
+"""
+This file implements a local mock of the LEGIFRANCE API endpoints
+used by extract_legipeche, to run the harvester without credentials.
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockLegifrance:
+    def __init__(
+        self,
+        n_containers: int = 10,
+        texts_per_container: int = 20,
+        latency: float = 0.0,
+        token_lifetime: float = 3600,
+        fail_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        Serves n_containers official journals (newest first) of
+        texts_per_container texts each, answering after latency seconds.
+        Tokens from /token expire after token_lifetime seconds, and a
+        fail_rate fraction of API calls is answered 429 or 503.
+        """
+        self.n_containers = n_containers
+        self.texts_per_container = texts_per_container
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def token(self) -> dict:
+        with self.lock:
+            token = f"mock{len(self.tokens)}"
+            self.tokens[token] = time.monotonic() + self.token_lifetime
+        return {
+            "access_token": token,
+            "token_type": "Bearer",
+            "expires_in": self.token_lifetime,
+        }
+
+    def authorized(self, authorization: str) -> bool:
+        token = (authorization or "").removeprefix("Bearer ")
+        return time.monotonic() < self.tokens.get(token, 0)
+
+    def failed(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.fail_rate
+
+    def container_id(self, i: int) -> str:
+        return f"JORFCONT{i:012d}"
+
+    def text_id(self, container: int, i: int) -> str:
+        return f"JORFTEXT{container:06d}{i:06d}"
+
+    def last_n_jo(self, payload: dict) -> dict:
+        return {
+            "containers": [
+                {
+                    "id": self.container_id(i),
+                    "num": str(i),
+                    "dateParution": 1609459200000 + i * 86400000,
+                }
+                for i in range(self.n_containers, 0, -1)
+            ][: payload["nbElement"]]
+        }
+
+    def jorf_cont(self, payload: dict) -> dict:
+        container = int(payload["id"][len("JORFCONT") :])
+        texts = [
+            {
+                "id": self.text_id(container, i),
+                "emetteur": "MINISTERE DE LA MER",
+                "nature": "ARRETE",
+                "titre": f"Arrêté n° {i} relatif à la pêche maritime",
+            }
+            for i in range(self.texts_per_container)
+        ]
+        structure = {
+            "tms": [
+                {
+                    "titre": "Décrets, arrêtés, circulaires",
+                    "liensTxt": texts,
+                },
+                {"titre": "Mesures nominatives", "liensTxt": texts[:1]},
+            ]
+        }
+        return {"items": [{"joCont": {"structure": structure}}]}
+
+    def jorf(self, payload: dict) -> dict:
+        return {
+            "articles": [
+                {
+                    "intOrdre": 2,
+                    "content": "<p>Les navires de pêche sont autorisés.</p>",
+                },
+                {
+                    "intOrdre": 1,
+                    "content": f"<p>Texte {payload['textCid']}</p>"
+                    "<p>Vu le code rural et de la pêche maritime ;</p>",
+                },
+            ],
+            "sections": [],
+        }
+
+    def start(self):
+        """
+        Serves the API from a background thread, on any free local port.
+        """
+        routes = {
+            "/consult/lastNJo": self.last_n_jo,
+            "/consult/jorfCont": self.jorf_cont,
+            "/consult/jorf": self.jorf,
+        }
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                data = self.rfile.read(length)
+                with mock.lock:
+                    mock.requests += 1
+                time.sleep(mock.latency)
+                if self.path == "/token":
+                    status, body = 200, mock.token()
+                elif self.path not in routes:
+                    status, body = 404, {}
+                elif not mock.authorized(self.headers.get("Authorization")):
+                    status, body = 401, {}
+                elif mock.failed():
+                    status, body = mock.random.choice([429, 503]), {}
+                else:
+                    status, body = 200, routes[self.path](json.loads(data))
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,157 @@
+"""
+This file implements the partitioned output dataset of the pipeline.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import corpus_dataset
+from preprocessing_cache import text_hash
+
+# Corpus columns, with the hash, words and topics found by the pipeline
+SCHEMA = pa.schema(
+    list(corpus_dataset.SCHEMA)
+    + [
+        ("text_hash", pa.string()),
+        ("words", pa.list_(pa.string())),
+        ("topics", pa.list_(pa.string())),
+        ("topic_scores", pa.list_(pa.float64())),
+    ]
+)
+
+
+def _partitioning(partition_on: str):
+    """
+    Hive partitioning on partition_on, whose values are read as strings.
+    """
+    return ds.partitioning(
+        pa.schema([(partition_on, pa.string())]), flavor="hive"
+    )
+
+
+def document_hashes(corpus: pd.DataFrame) -> pd.Series:
+    """
+    Hash of the raw title and text of each document.
+    """
+    return (corpus["titre"] + "\n" + corpus["text"]).map(text_hash)
+
+
+def _to_table(output: pd.DataFrame, partition_on: str) -> pa.Table:
+    """
+    Converts scored documents to arrow, with the columns of SCHEMA.
+    """
+    output = output.assign(**{partition_on: output[partition_on].astype(str)})
+    return pa.Table.from_pandas(output, schema=SCHEMA, preserve_index=False)
+
+
+def scored_hashes(path: str, partition_on: str) -> pd.Series:
+    """
+    Returns the text hashes of the documents in the output dataset,
+    indexed by id.
+    """
+    if not os.path.exists(path):
+        return pd.Series(dtype=str)
+    dataset = ds.dataset(
+        path,
+        schema=SCHEMA,
+        format="parquet",
+        partitioning=_partitioning(partition_on),
+    )
+    return (
+        dataset.to_table(columns=["id", "text_hash"])
+        .to_pandas()
+        .set_index("id")["text_hash"]
+    )
+
+
+def changed(corpus: pd.DataFrame, scored: pd.Series) -> np.ndarray:
+    """
+    Mask of the documents of corpus that are not in scored_hashes
+    or whose title/text changed since they were scored.
+    """
+    return (corpus["id"].map(scored) != corpus["text_hash"]).to_numpy()
+
+
+def write_batches(outputs, path: str, partition_on: str):
+    """
+    Writes an iterable of scored DataFrames as a new dataset in path,
+    holding a single batch in memory at a time. The dataset is written
+    aside and only replaces the previous one once complete.
+    """
+    new_path = path + ".new"
+    old_path = path + ".old"
+    shutil.rmtree(new_path, ignore_errors=True)
+    os.makedirs(new_path)
+    batches = (
+        batch
+        for output in outputs
+        for batch in _to_table(output, partition_on).to_batches()
+    )
+    ds.write_dataset(
+        batches,
+        new_path,
+        schema=SCHEMA,
+        format="parquet",
+        partitioning=_partitioning(partition_on),
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    # Without documents, no dataset is left in path
+    if os.listdir(new_path):
+        os.replace(new_path, path)
+    else:
+        os.rmdir(new_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def write(
+    output: pd.DataFrame, path: str, partition_on: str, merge: bool
+) -> set:
+    """
+    Writes the scored documents to the dataset in path, partitioned by
+    partition_on. With merge, only partitions containing these documents
+    (or their previous version) are rewritten, other ones are left as is.
+
+    Returns:
+        set: values of partition_on of the partitions written
+    """
+    output = output.assign(**{partition_on: output[partition_on].astype(str)})
+    partitioning = _partitioning(partition_on)
+
+    if merge and os.path.exists(path):
+        dataset = ds.dataset(
+            path, schema=SCHEMA, format="parquet", partitioning=partitioning
+        )
+        ids = pa.array(output["id"])
+        previous = dataset.to_table(
+            columns=[partition_on], filter=ds.field("id").isin(ids)
+        )
+        touched = set(output[partition_on])
+        touched |= set(previous[partition_on].to_pylist())
+        kept = dataset.to_table(
+            filter=ds.field(partition_on).isin(list(touched))
+            & ~ds.field("id").isin(ids)
+        ).to_pandas()
+        output = pd.concat([kept, output], ignore_index=True)
+        existing_data_behavior = "delete_matching"
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+        touched = set(output[partition_on])
+        existing_data_behavior = "overwrite_or_ignore"
+
+    ds.write_dataset(
+        _to_table(output, partition_on),
+        path,
+        format="parquet",
+        partitioning=partitioning,
+        existing_data_behavior=existing_data_behavior,
+    )
+    return touched
@@ -0,0 +1,103 @@
+"""
+This file implements an on-disk cache of preprocessed documents.
+"""
+
+import hashlib
+import sqlite3
+
+import pandas as pd
+
+# Maximum number of ids per sqlite query
+CHUNK_SIZE = 500
+
+
+def text_hash(text: str) -> str:
+    """
+    Hash of the content of a document.
+    """
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class PreprocessingCache:
+    def __init__(self, path: str, fingerprint: str):
+        """
+        Opens (or creates) the cache stored in the sqlite file path.
+        Entries preprocessed with another fingerprint are ignored.
+        """
+        self.fingerprint = fingerprint
+        # Used sequentially, but possibly from a writer thread of pyarrow
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT,
+                field TEXT,
+                text_hash TEXT,
+                fingerprint TEXT,
+                processed TEXT,
+                PRIMARY KEY (id, field)
+            )
+            """
+        )
+
+    def lookup(self, field: str, ids, texts) -> list:
+        """
+        Returns the cached preprocessed texts, None where the document
+        is missing or its text or the preprocessing changed since.
+        """
+        ids = [str(id) for id in ids]
+        found = {}
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start : start + CHUNK_SIZE]
+            rows = self.connection.execute(
+                "SELECT id, text_hash, processed FROM documents "
+                "WHERE field = ? AND fingerprint = ? "
+                f"AND id IN ({', '.join('?' * len(chunk))})",
+                [field, self.fingerprint, *chunk],
+            )
+            found.update({row[0]: row[1:] for row in rows})
+
+        output = []
+        for id, text in zip(ids, texts):
+            stored, processed = found.get(id, (None, None))
+            output.append(processed if stored == text_hash(text) else None)
+        return output
+
+    def store(self, field: str, ids, texts, processed):
+        """
+        Saves preprocessed texts, replacing previous entries.
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+            [
+                (str(id), field, text_hash(text), self.fingerprint, output)
+                for id, text, output in zip(ids, texts, processed)
+            ],
+        )
+        self.connection.commit()
+
+    def preprocess(self, field: str, ids, texts, preprocess) -> list:
+        """
+        Returns preprocess(texts), only calling preprocess on the texts
+        missing from the cache, then caching them.
+        """
+        texts = pd.Series(list(texts))
+        ids = list(ids)
+        output = self.lookup(field, ids, texts)
+
+        missing = [i for i, cached in enumerate(output) if cached is None]
+        if missing:
+            missing_texts = texts.iloc[missing].reset_index(drop=True)
+            computed = list(preprocess(missing_texts))
+            for i, processed in zip(missing, computed):
+                output[i] = processed
+            self.store(
+                field, [ids[i] for i in missing], missing_texts, computed
+            )
+        return output
+
+    def close(self):
+        """
+        Closes the sqlite connection.
+        """
+        self.connection.close()
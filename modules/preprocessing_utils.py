@@ -2,26 +2,164 @@
 This file implements different preprocessing utils functions.
 """
 
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import re
 from stopwords import stopwords_nltk, stopwords_specific
 import spacy
+import sys
 import unicodedata
 
+# spaCy components not needed to lemmatize
+UNUSED_PIPES = ["parser", "ner"]
+# Bump when a change of the functions below changes their output
+PREPROCESSING_VERSION = "1"
+# Number of chunks given to each worker of workers(), to balance their load
+CHUNKS_PER_PROCESS = 4
+# spaCy pipeline of a worker process, set once by _init_worker
+_worker_nlp = None
+
+
 def preprocess_string(nlp, input_string):
     """
     Wraps all operations to ensure common normalization.
     """
-    processed_string = input_string.lower()
-    processed_string = special_structures(processed_string)
     #NA for match processed_string = remove_stopwords(processed_string)
-    processed_string = replace_digit(processed_string)
-    processed_string = remove_trailings(processed_string)
-    processed_string = strip_accents(processed_string)
+    processed_string = normalize(input_string)
     #processed_string = lemmatize(nlp, processed_string)
     return processed_string
 
 
+def preprocess_corpus(nlp, texts, batch_size=256, n_process=1):
+    """
+    Normalizes and lemmatizes an iterable of strings.
+    Documents are streamed through nlp.pipe by batches of batch_size
+    on n_process processes (-1 uses all cores, only worth it for
+    large batches).
+    """
+    if isinstance(texts, pd.Series):
+        normalized = preprocess_series(texts)
+    else:
+        normalized = (preprocess_string(nlp, text) for text in texts)
+    return _lemmatize(nlp, normalized, batch_size, n_process)
+
+
+def _lemmatize(nlp, normalized, batch_size=256, n_process=1) -> list:
+    """
+    Lemmatizes normalized strings through nlp.pipe.
+    """
+    disable = [pipe for pipe in UNUSED_PIPES if pipe in nlp.pipe_names]
+    docs = nlp.pipe(
+        normalized,
+        batch_size=batch_size,
+        n_process=n_process,
+        disable=disable,
+    )
+    return [" ".join([token.lemma_ for token in doc]) for doc in docs]
+
+
+def _init_worker(nlp):
+    """
+    Keeps the spaCy pipeline sent to a worker process when it starts.
+    """
+    global _worker_nlp
+    _worker_nlp = nlp
+
+
+def _lemmatize_chunk(batch_size: int, chunk: list) -> list:
+    """
+    Lemmatizes a chunk of normalized strings in a worker process.
+    """
+    return _lemmatize(_worker_nlp, chunk, batch_size)
+
+
+@contextmanager
+def workers(nlp, n_process: int = -1, batch_size: int = 256):
+    """
+    Keeps n_process worker processes (-1 for all cores) with their copy
+    of nlp until exit, and yields a function preprocessing texts as
+    preprocess_corpus does. Texts are split between the workers, which
+    nlp.pipe would start again on every call, unless it is called with
+    parallel=False (for short texts, such as titles).
+    """
+    if n_process == -1:
+        n_process = os.cpu_count()
+    if n_process == 1:
+        yield lambda texts, parallel=True: preprocess_corpus(
+            nlp, texts, batch_size=batch_size
+        )
+        return
+
+    with ProcessPoolExecutor(
+        n_process, initializer=_init_worker, initargs=(nlp,)
+    ) as pool:
+
+        def preprocess(texts, parallel=True):
+            if not parallel:
+                return preprocess_corpus(nlp, texts, batch_size=batch_size)
+            if isinstance(texts, pd.Series):
+                normalized = list(preprocess_series(texts))
+            else:
+                normalized = [preprocess_string(nlp, text) for text in texts]
+            size = -(-len(normalized) // (n_process * CHUNKS_PER_PROCESS))
+            chunks = [
+                normalized[start : start + size]
+                for start in range(0, len(normalized), size or 1)
+            ]
+            found = pool.map(partial(_lemmatize_chunk, batch_size), chunks)
+            return [text for chunk in found for text in chunk]
+
+        yield preprocess
+
+
+def preprocessing_fingerprint(nlp=None) -> str:
+    """
+    Hash of the preprocessing configuration (normalizer and spaCy model),
+    used to invalidate cached preprocessed documents.
+    """
+    configuration = [
+        PREPROCESSING_VERSION,
+        unicodedata.unidata_version,
+        pa.__version__,
+        FIRST_PATTERN.pattern,
+        SPECIAL_PATTERN.pattern,
+        ASCII_TABLE.hex(),
+    ]
+    if nlp is not None:
+        configuration += [nlp.meta["name"], nlp.meta["version"]]
+        configuration += nlp.pipe_names
+    return hashlib.sha1("\n".join(configuration).encode()).hexdigest()
+
+
+def preprocess_series(input_series: pd.Series) -> pd.Series:
+    """
+    Column-level equivalent of normalize, applying each step
+    to the whole column at once with pyarrow compute kernels.
+    """
+    processed = pa.array(
+        input_series, type=pa.large_string(), from_pandas=True
+    )
+    processed = pc.utf8_lower(processed)
+    processed = pc.replace_substring_regex(
+        processed, "1er[ '()]|n°|['(),«»]", " "
+    )
+    digits, spaces = arrow_patterns()
+    processed = pc.replace_substring_regex(processed, digits, "")
+    processed = pc.replace_substring_regex(processed, spaces, " ")
+    processed = pc.utf8_trim(processed, " ")
+    processed = pc.utf8_normalize(processed, "NFD")
+    processed = pc.replace_substring_regex(processed, "[^\\x00-\\x7f]+", "")
+    return processed.to_pandas().set_axis(input_series.index).rename(
+        input_series.name
+    )
+
+
 """#############"""
 """Sub-functions"""
 """#############"""
@@ -92,6 +230,137 @@ def strip_accents(text):
 
     return str(text)
 
+
+"""###################"""
+"""Compiled normalizer"""
+"""###################"""
+
+# Marks characters removed by strip_accents, dropped after remove_trailings
+VANISHED = "\x00"
+
+
+def _is_plain(char):
+    """
+    Whether lowering char then stripping its accents only gives
+    letters or punctuation left untouched by the other sub-functions.
+    """
+    lowered = char.lower()
+    stripped = strip_accents(lowered)
+    return (
+        stripped != ""
+        and stripped == strip_accents(char).lower()
+        and not any(c.isdigit() or c.isspace() for c in lowered + stripped)
+        and not any(c in "'(),«»" + VANISHED for c in lowered + stripped)
+    )
+
+
+# Latin letters (accented or not) go straight to strip_accents, any other
+# non ascii character is replaced beforehand by _SpecialReplacements.
+PLAIN_CHARACTERS = "".join(
+    char
+    for code in list(range(0x80, 0x250)) + list(range(0x1E00, 0x1F00))
+    if _is_plain(char := chr(code))
+)
+FIRST_PATTERN = re.compile(r"1[eE][rR](?=[ '()])")
+SPECIAL_PATTERN = re.compile("[^\x00-\x7f" + PLAIN_CHARACTERS + "]+")
+# Lowers ascii letters, removes digits and special characters in one pass
+ASCII_TABLE = bytes.maketrans(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZ'(),\x1c\x1d\x1e\x1f",
+    b"abcdefghijklmnopqrstuvwxyz        ",
+)
+
+
+class _SpecialReplacements(dict):
+    """
+    Replacements of SPECIAL_PATTERN matches, computed once per match.
+    """
+
+    def __missing__(self, match):
+        replacement = ""
+        for char in match.lower():
+            if char.isspace() or char in "«»":
+                replacement += " "
+            elif not char.isdigit():
+                replacement += strip_accents(char) or VANISHED
+        self[match] = replacement
+        return replacement
+
+
+SPECIAL_REPLACEMENTS = _SpecialReplacements()
+
+
+def normalize(input_string):
+    """
+    Compiled equivalent of lower, special_structures, replace_digit,
+    remove_trailings and strip_accents: non latin characters are replaced
+    in one regex pass, everything else is done on ascii bytes.
+    """
+    if VANISHED in input_string:
+        return legacy_normalize(input_string)
+
+    # Same order as special_structures: "1er " before "n°"
+    processed_string = FIRST_PATTERN.sub(" ", input_string)
+    processed_string = processed_string.replace("n°", " ").replace("N°", " ")
+    processed_string = SPECIAL_PATTERN.sub(
+        lambda match: SPECIAL_REPLACEMENTS[match.group()], processed_string
+    )
+    processed_bytes = (
+        unicodedata.normalize("NFD", processed_string)
+        .encode("ascii", "ignore")
+        .translate(ASCII_TABLE, b"0123456789")
+    )
+    processed_bytes = b" ".join(processed_bytes.split())
+    return processed_bytes.replace(VANISHED.encode(), b"").decode()
+
+
+def legacy_normalize(input_string):
+    """
+    Reference chain of sub-functions implemented by normalize.
+    """
+    processed_string = input_string.lower()
+    processed_string = special_structures(processed_string)
+    processed_string = replace_digit(processed_string)
+    processed_string = remove_trailings(processed_string)
+    processed_string = strip_accents(processed_string)
+    return processed_string
+
+
+def _arrow_class(chars):
+    """
+    Character class of chars, in the regex syntax of pyarrow (RE2).
+    """
+    ranges = []
+    for code in sorted(map(ord, chars)):
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return "[" + "".join(
+        f"\\x{{{start:x}}}-\\x{{{end:x}}}" for start, end in ranges
+    ) + "]"
+
+
+@lru_cache(maxsize=None)
+def arrow_patterns():
+    """
+    Returns the pyarrow regexes of the digits removed by replace_digit
+    and of the whitespace split by remove_trailings. Built on first use,
+    as scanning all of unicode takes a fifth of a second.
+    """
+    digits = []
+    spaces = []
+    for code in range(sys.maxunicode + 1):
+        if chr(code).isdigit():
+            digits.append(chr(code))
+        elif chr(code).isspace():
+            spaces.append(chr(code))
+    # Runs of whitespace, skipping the single spaces already in place
+    return _arrow_class(digits) + "+", (
+        _arrow_class(spaces)
+        + "{2,}|"
+        + _arrow_class([char for char in spaces if char != " "])
+    )
+
 # UNUSED
 def regex_loi(input_series: pd.Series) -> pd.Series:
     """
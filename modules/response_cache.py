@@ -0,0 +1,132 @@
+"""
+This file implements an on-disk cache of HTTP responses, revalidated
+with their ETag / Last-Modified once stale, and bounded in size by
+evicting the least recently used ones.
+"""
+
+import sqlite3
+import threading
+import time
+
+# Bytes of response bodies kept on disk
+MAX_SIZE = 1024**3
+# Seconds a response is served without asking the server
+MAX_AGE = 7 * 24 * 3600
+
+
+class ResponseCache:
+    def __init__(
+        self, path: str, max_size: int = MAX_SIZE, max_age: float = MAX_AGE
+    ):
+        """
+        Opens (or creates) the cache stored in the sqlite file path,
+        keeping at most max_size bytes of responses, fresh for max_age
+        seconds after they were stored or revalidated.
+        """
+        self.max_size = max_size
+        self.max_age = max_age
+        # Shared by the threads of a client
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER,
+                stored_at REAL,
+                used_at REAL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_used_at "
+            "ON responses (used_at)"
+        )
+        self.size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def lookup(self, key: str, max_age: float = None):
+        """
+        Returns the cached (body, etag, last_modified, fresh) of a key,
+        None if it is not cached. When given, max_age shortens the time
+        the response is fresh.
+        """
+        if max_age is None or max_age > self.max_age:
+            max_age = self.max_age
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body, etag, last_modified, stored_at FROM responses "
+                "WHERE key = ?",
+                [key],
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE responses SET used_at = ? WHERE key = ?", [now, key]
+            )
+            self.connection.commit()
+        body, etag, last_modified, stored_at = row
+        return body, etag, last_modified, now - stored_at < max_age
+
+    def store(self, key: str, body: str, etag=None, last_modified=None):
+        """
+        Saves a response, replacing the previous one, then evicts the least
+        recently used responses beyond max_size.
+        """
+        now = time.time()
+        size = len(body.encode())
+        with self.lock:
+            previous = self.connection.execute(
+                "SELECT size FROM responses WHERE key = ?", [key]
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [key, body, etag, last_modified, size, now, now],
+            )
+            self.size += size - (previous[0] if previous else 0)
+            self._evict()
+            self.connection.commit()
+
+    def revalidated(self, key: str):
+        """
+        Marks a response as fresh again, the server having answered
+        304 Not Modified.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "UPDATE responses SET stored_at = ?, used_at = ? "
+                "WHERE key = ?",
+                [now, now, key],
+            )
+            self.connection.commit()
+
+    def _evict(self):
+        """
+        Deletes the least recently used responses until within max_size.
+        """
+        if self.size <= self.max_size:
+            return
+        evicted = []
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY used_at"
+        ):
+            if self.size <= self.max_size:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.connection.executemany(
+            "DELETE FROM responses WHERE key = ?", evicted
+        )
+
+    def close(self):
+        """
+        Closes the sqlite connection.
+        """
+        self.connection.close()
@@ -0,0 +1,279 @@
+"""
+This file implements the HTTP topic service: concurrent requests are
+micro-batched into vectorized topic finder calls.
+
+Endpoints:
+    POST /topics   {"title": ..., "text": ...} -> {"words": ..., "topics": ...}
+    GET /metrics   throughput, batch sizes and latencies
+"""
+
+import asyncio
+import json
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+import preprocessing_utils as utils
+
+HOST = "127.0.0.1"
+PORT = 8050
+# Largest number of documents extracted at once
+MAX_BATCH_SIZE = 256
+# Seconds a lone request waits for others to join its batch
+MAX_DELAY = 0.002
+# Number of last requests the latency metrics are computed on
+LATENCY_WINDOW = 10000
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class Metrics:
+    def __init__(self, window: int = LATENCY_WINDOW):
+        """
+        Counters of the service, with the end time and latency
+        of the last window requests.
+        """
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.documents = 0
+        self.latencies = deque(maxlen=window)
+
+    def record_request(self, latency: float):
+        self.requests += 1
+        self.latencies.append((time.perf_counter(), latency))
+
+    def record_batch(self, size: int):
+        self.batches += 1
+        self.documents += size
+
+    def snapshot(self) -> dict:
+        """
+        Returns the metrics as a json serializable dict.
+        """
+        metrics = {
+            "uptime_s": time.perf_counter() - self.start,
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": self.documents / max(self.batches, 1),
+        }
+        if len(self.latencies) > 1:
+            ends, latencies = zip(*self.latencies)
+            elapsed = ends[-1] - ends[0]
+            metrics["throughput_rps"] = (len(ends) - 1) / max(elapsed, 1e-9)
+            for q, value in zip(
+                [50, 95, 99], np.percentile(latencies, [50, 95, 99])
+            ):
+                metrics[f"latency_p{q}_ms"] = value * 1000
+        return metrics
+
+
+class TopicService:
+    def __init__(
+        self,
+        topic_finder,
+        nlp=None,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_delay: float = MAX_DELAY,
+    ):
+        """
+        Serves the topics of topic_finder, documents being preprocessed
+        as preprocess_corpus with nlp (only normalized without nlp).
+        """
+        self.topic_finder = topic_finder
+        self.topic_positions = {
+            topic: i for i, topic in enumerate(topic_finder.topics)
+        }
+        self.nlp = nlp
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.metrics = Metrics()
+        self.queue = asyncio.Queue()
+        self.server = None
+        self.batcher = None
+
+    def extract_batch(self, titles: list, texts: list) -> list:
+        """
+        Returns the words and topics of each (title, text) document,
+        titles and texts being extracted by one column call.
+        """
+        column = pd.Series(titles + texts, dtype=object)
+        if self.nlp is None:
+            column = utils.preprocess_series(column)
+        else:
+            column = pd.Series(
+                utils.preprocess_corpus(self.nlp, column, n_process=1)
+            )
+        found = self.topic_finder.column_extract_topics(column)
+
+        results = []
+        n = len(titles)
+        for i in range(n):
+            words = found["words"][i] + [
+                word
+                for word in found["words"][n + i]
+                if word not in found["words"][i]
+            ]
+            topics = sorted(
+                set(found["topics"][i]) | set(found["topics"][n + i]),
+                key=self.topic_positions.get,
+            )
+            results.append({"words": words, "topics": topics})
+        return results
+
+    async def batch_loop(self):
+        """
+        Extracts queued documents by batches of at most max_batch_size,
+        off the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.empty():
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            titles, texts, futures = zip(*batch)
+            try:
+                results = await loop.run_in_executor(
+                    None, self.extract_batch, list(titles), list(texts)
+                )
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future, result in zip(futures, results):
+                    if not future.done():
+                        future.set_result(result)
+            self.metrics.record_batch(len(batch))
+
+    async def extract(self, title: str, text: str) -> dict:
+        """
+        Returns the words and topics of a document, once its batch is done.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((title, text, future))
+        return await future
+
+    async def route(self, method: str, target: str, body: bytes) -> tuple:
+        """
+        Returns the status and json payload answering a request.
+        """
+        if method == "GET" and target == "/metrics":
+            return 200, self.metrics.snapshot()
+        if method != "POST" or target != "/topics":
+            return 404, {"error": f"no route {method} {target}"}
+
+        try:
+            document = json.loads(body)
+            title = document.get("title", "")
+            text = document.get("text", "")
+            if not isinstance(title, str) or not isinstance(text, str):
+                raise ValueError("title and text must be strings")
+        except (ValueError, AttributeError) as e:
+            return 400, {"error": str(e)}
+
+        start = time.perf_counter()
+        result = await self.extract(title, text)
+        self.metrics.record_request(time.perf_counter() - start)
+        return 200, result
+
+    async def handle(self, reader, writer):
+        """
+        Answers the HTTP/1.1 requests of a connection, kept alive
+        unless the client closes it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    method, target, version = (
+                        request_line.decode("latin-1").split()
+                    )
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(f"negative length {length}")
+                except ValueError:
+                    status, payload, keep_alive = 400, {}, False
+                else:
+                    keep_alive = (
+                        version == "HTTP/1.1"
+                        and headers.get("connection", "").lower() != "close"
+                    )
+                    if length > MAX_BODY_SIZE:
+                        status, payload, keep_alive = 413, {}, False
+                    else:
+                        body = await reader.readexactly(length)
+                        try:
+                            status, payload = await self.route(
+                                method, target, body
+                            )
+                        except Exception as e:
+                            status, payload = 500, {"error": str(e)}
+                if status >= 400:
+                    self.metrics.errors += 1
+
+                content = json.dumps(payload, ensure_ascii=False).encode()
+                connection = "keep-alive" if keep_alive else "close"
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                        "Content-Type: application/json; charset=utf-8\r\n"
+                        f"Content-Length: {len(content)}\r\n"
+                        f"Connection: {connection}\r\n\r\n"
+                    ).encode()
+                    + content
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = HOST, port: int = PORT):
+        """
+        Starts the batch loop and listens on host:port (0 for any free port).
+        """
+        self.batcher = asyncio.create_task(self.batch_loop())
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+
+
+async def serve(service: TopicService, host: str = HOST, port: int = PORT):
+    """
+    Runs the service until interrupted.
+    """
+    server = await service.start(host, port)
+    print(f"Serving topics on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
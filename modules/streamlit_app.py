@@ -3,13 +3,73 @@ This file implements the streamlit display application.
 """
 
 import streamlit as st
+import numpy as np
 import pandas as pd
-import spacy
-import preprocessing_utils as utils
-from collections import Counter
+import pyarrow as pa
+import analytics
+import corpus_dataset
+import knowledge_base
+from topicfinder import lists_to_matrix
 import plotly.graph_objects as go
 import networkx as nx
 
+OUTPUT_PATH = "C:/Users/karkl/Desktop/NCC/datasets/output"
+# Topic statistics written with the output (see analytics.py)
+STATS_PATH = "C:/Users/karkl/Desktop/NCC/datasets/topic_stats"
+# First publication date displayed (YYYY-MM-DD), None for all
+SINCE = None
+# Columns filtered on by equality
+CATEGORY_COLUMNS = ["emetteur", "nature"]
+
+
+class FilterIndex:
+    def __init__(self, dataset: pd.DataFrame, topics: list, words: list):
+        """
+        Indexes of the rows of dataset, built once per loaded dataset:
+        document x topic and document x word matrices, whose columns list
+        the rows of each topic or word, and categorical codes of the
+        CATEGORY_COLUMNS.
+        """
+        self.n_rows = len(dataset)
+        self.topic_ids = {topic: i for i, topic in enumerate(topics)}
+        self.word_ids = {word: i for i, word in enumerate(words)}
+        self.topic_matrix = lists_to_matrix(dataset["topics"], topics).tocsc()
+        self.word_matrix = lists_to_matrix(dataset["words"], words).tocsc()
+        # Categories in order of appearance, as offered by the sidebar
+        self.categories = {
+            column: pd.Categorical(
+                dataset[column], categories=dataset[column].dropna().unique()
+            )
+            for column in CATEGORY_COLUMNS
+        }
+
+    def _bitmap(self, matrix, columns: list) -> np.ndarray:
+        """
+        Boolean mask of the rows with a non zero value in any of columns.
+        """
+        mask = np.zeros(self.n_rows, dtype=bool)
+        for j in columns:
+            start, end = matrix.indptr[j], matrix.indptr[j + 1]
+            mask[matrix.indices[start:end]] = True
+        return mask
+
+    def select(self, topic: str, words: list, **values) -> np.ndarray:
+        """
+        Returns the positions of the rows about topic, with any of words,
+        and whose CATEGORY_COLUMNS equal values.
+        """
+        mask = self._bitmap(self.topic_matrix, [self.topic_ids[topic]])
+        mask &= self._bitmap(
+            self.word_matrix,
+            [self.word_ids[word] for word in words if word in self.word_ids],
+        )
+        for column, value in values.items():
+            categorical = self.categories[column]
+            code = categorical.categories.get_indexer([value])[0]
+            # -1 is also the code of missing values
+            mask &= (categorical.codes == code) & (code != -1)
+        return np.flatnonzero(mask)
+
 
 def show():
     """
@@ -17,32 +77,70 @@ def show():
     """
     # Reads datasets
     if "dataset" not in st.session_state:
-        st.session_state.dataset = pd.read_parquet(
-            "C:/Users/karkl/Desktop/NCC/datasets/output3.parquet"
-        )
-
-        # Loads (keywords), TODO: Simplify too long.
-        keywords_topics = pd.read_excel(
-            "C:/Users/karkl/Desktop/NCC/datasets/topic_knownledge.xlsx"
-        )
+        # Only the date folders since SINCE are read, topics scoring
+        # below the threshold of the statistics left out
+        st.session_state.dataset = analytics.cut_topics(
+            corpus_dataset.dataset(OUTPUT_PATH).to_table(
+                filter=corpus_dataset.date_filter(since=SINCE)
+            )
+        ).to_pandas()
 
-        nlp = spacy.load("fr_core_news_sm")
+        # Loads keywords, compiled once by the pipeline
+        st.session_state.keywords_topics = knowledge_base.load(
+            "C:/Users/karkl/Desktop/NCC/datasets/topic_knownledge.xlsx",
+            "C:/Users/karkl/Desktop/NCC/datasets/topic_knownledge.pickle",
+        ).keywords_topics
 
-        keywords_topics = pd.DataFrame(
-            keywords_topics.stack().droplevel(0), columns=["words"]
-        )
-        keywords_topics["words"] = keywords_topics["words"].apply(
-            lambda x: utils.preprocess_string(nlp, x)
+        # Filter indexes, built once per loaded dataset
+        st.session_state.topic_list = (
+            st.session_state.keywords_topics["topic"].tolist()
         )
-        keywords_topics = keywords_topics.reset_index().rename(
-            columns={"index": "topic"}
-        )
-        st.session_state.keywords_topics = (
-            keywords_topics.groupby(["topic"])
-            .agg({"words": lambda x: list(x)})
-            .reset_index()
+        st.session_state.filter_index = FilterIndex(
+            st.session_state.dataset,
+            st.session_state.topic_list,
+            list(
+                dict.fromkeys(
+                    word
+                    for words in st.session_state.keywords_topics["words"]
+                    for word in words
+                )
+            ),
         )
 
+        # Pre-aggregated topic statistics, computed here for an output
+        # written before them. The fingerprint of the data they come from
+        # keys the charts cached across reruns and sessions.
+        try:
+            st.session_state.fingerprint = analytics.fingerprint(
+                STATS_PATH, analytics.COOCCURRENCE_FILE, since=SINCE
+            )
+            st.session_state.topic_counts, st.session_state.cooccurrence = [
+                analytics.read(STATS_PATH, file_name, since=SINCE)
+                for file_name in [
+                    analytics.COUNTS_FILE,
+                    analytics.COOCCURRENCE_FILE,
+                ]
+            ]
+        except FileNotFoundError:
+            st.session_state.fingerprint = corpus_dataset.fingerprint(
+                OUTPUT_PATH, since=SINCE
+            )
+            aggregates = analytics.aggregate(
+                pa.Table.from_pandas(
+                    st.session_state.dataset[
+                        ["topics", "topic_scores"]
+                        + analytics.GROUP_COLUMNS
+                    ],
+                    preserve_index=False,
+                )
+            )
+            st.session_state.topic_counts = aggregates[
+                analytics.COUNTS_FILE
+            ].to_pandas()
+            st.session_state.cooccurrence = aggregates[
+                analytics.COOCCURRENCE_FILE
+            ].to_pandas()
+
     st.title("Explorateur de catégories sur LégiFrance")
 
     st.session_state.page = (
@@ -50,11 +148,13 @@ def show():
     ) = st.sidebar.selectbox("Module: ", ["Textes", "Network", "Graphique"])
 
     if st.session_state.page == "Textes":
-        sidebar(st.session_state.keywords_topics, st.session_state.dataset)
-        _filter_text(st.session_state.dataset)
+        sidebar(
+            st.session_state.keywords_topics, st.session_state.filter_index
+        )
+        _filter_text(st.session_state.dataset, st.session_state.filter_index)
     elif st.session_state.page == "Network":
         st.session_state.network_chart = create_graph_chart(
-            st.session_state.dataset
+            st.session_state.fingerprint, st.session_state.cooccurrence
         )
         st.plotly_chart(st.session_state.network_chart)
         pass
@@ -65,14 +165,14 @@ def show():
         )
         st.plotly_chart(
             create_bar_chart(
-                st.session_state.dataset,
+                st.session_state.topic_counts,
                 "nature",
                 st.session_state.selected_topic,
             )
         )
 
 
-def sidebar(keywords_topic, dataset):
+def sidebar(keywords_topic, filter_index):
 
     topic_list = keywords_topic.iloc[:, 0].tolist()
     keywords_list = keywords_topic.iloc[:, 1].tolist()
@@ -89,38 +189,24 @@ def sidebar(keywords_topic, dataset):
 
     st.session_state.selected_emetteur = st.sidebar.selectbox(
         "Emetteur: ",
-        dataset["emetteur"].drop_duplicates().tolist(),
+        filter_index.categories["emetteur"].categories.tolist(),
     )
 
     st.session_state.selected_nature = st.sidebar.selectbox(
         "Nature: ",
-        dataset["nature"].drop_duplicates().tolist(),
+        filter_index.categories["nature"].categories.tolist(),
     )
 
 
-def _filter_text(dataset):
+def _filter_text(dataset, filter_index):
     try:
-        filtered = dataset[
-            dataset["topics"].apply(
-                lambda x: st.session_state.selected_topic in x
-            )
-        ]
-
-        filtered = filtered[
-            filtered["words"].apply(
-                lambda x: not set(st.session_state.selected_word).isdisjoint(x)
-            )
-        ]
-
-        filtered = filtered[
-            filtered["emetteur"].apply(
-                lambda x: x == st.session_state.selected_emetteur
-            )
-        ]
-
-        filtered = filtered[
-            filtered["nature"].apply(
-                lambda x: x == st.session_state.selected_nature
+        # Intersection of row bitmaps, the dataset being only indexed once
+        filtered = dataset.iloc[
+            filter_index.select(
+                st.session_state.selected_topic,
+                st.session_state.selected_word,
+                emetteur=st.session_state.selected_emetteur,
+                nature=st.session_state.selected_nature,
             )
         ]
 
@@ -147,36 +233,54 @@ def _filter_text(dataset):
 # Present charts
 
 
-def create_graph_chart(df: pd.DataFrame):
+def create_graph_chart(fingerprint: str, cooccurrence: pd.DataFrame):
     """
-    Creates the network chart.
+    Creates the network chart of the co-occurrence counts identified by
+    fingerprint.
     """
-    # create graph
-    G = _create_graph(df)
+    # create graph, computed once per co-occurrence counts
+    G = _create_graph(fingerprint, cooccurrence)
 
     # data for plotly
     data = []
 
-    # create edges
-    weights = []
+    # create edges, as one trace of segments separated by None
     edges_x = []
     edges_y = []
-    for edge in G.edges():
-        x0, y0 = G.nodes[edge[0]]["pos"]
-        x1, y1 = G.nodes[edge[1]]["pos"]
-        edges_x.append((x0, x1))
-        edges_y.append((y0, y1))
-        weights.append(G.get_edge_data(edge[0], edge[1])["weight"])
-
-    for edge_x, edge_y, weight in zip(edges_x, edges_y, weights):
-        edge_trace = go.Scatter(
-            x=edge_x,
-            y=edge_y,
-            line=dict(width=weight * 5, color="#888"),
+    middles_x = []
+    middles_y = []
+    weights = []
+    hover = []
+    for topic1, topic2, weight in G.edges(data="weight"):
+        x0, y0 = G.nodes[topic1]["pos"]
+        x1, y1 = G.nodes[topic2]["pos"]
+        edges_x.extend((x0, x1, None))
+        edges_y.extend((y0, y1, None))
+        middles_x.append((x0 + x1) / 2)
+        middles_y.append((y0 + y1) / 2)
+        weights.append(weight)
+        hover.append(f"{topic1} - {topic2}: {weight:.2f}")
+
+    data.append(
+        go.Scatter(
+            x=edges_x,
+            y=edges_y,
+            line=dict(width=1, color="#888"),
             hoverinfo="none",
             mode="lines",
         )
-        data.append(edge_trace)
+    )
+    # weights, which a single trace cannot show as line widths
+    data.append(
+        go.Scatter(
+            x=middles_x,
+            y=middles_y,
+            mode="markers",
+            hovertext=hover,
+            hoverinfo="text",
+            marker=dict(size=np.array(weights) * 10, color="#888"),
+        )
+    )
 
     # create nodes
     node_x = []
@@ -215,27 +319,22 @@ def create_graph_chart(df: pd.DataFrame):
     return fig
 
 
-def _create_graph(df: pd.DataFrame):
+@st.cache_data(show_spinner=False)
+def _create_graph(fingerprint: str, _cooccurrence: pd.DataFrame):
     """
-    Internal function to plot charts.
+    Internal function to plot charts: the topic co-occurrence graph of the
+    dataset and its layout, cached by the fingerprint of the co-occurrence
+    counts (the counts by date not being hashed).
     """
-    # co-occurences counter
-    ct = Counter()
-    for topics in df["topics"]:
-        for i in range(len(topics)):
-            for j in range(i):
-                topic1, topic2 = sorted((topics[i], topics[j]))
-                ct[(topic1, topic2)] += 1
-
-    # normalize weight
-    max_weight = max(weight for weight in ct.values())
-    cooc = {topic: weight / max_weight for topic, weight in ct.items()}
-
-    # graph from counter
+    # co-occurences of each pair of topics over all dates
+    cooc = _cooccurrence.groupby(["topic1", "topic2"])["count"].sum()
+
+    # graph from normalized weights
     G = nx.Graph()
-    for edge, weight in cooc.items():
-        topic1, topic2 = edge
-        G.add_edge(topic1, topic2, weight=weight)
+    if len(cooc) > 0:
+        weights = cooc / cooc.max()
+        for (topic1, topic2), weight in weights.items():
+            G.add_edge(topic1, topic2, weight=float(weight))
 
     # add position to display in plotly
     pos = nx.spring_layout(G, weight="weights")
@@ -245,11 +344,11 @@ def _create_graph(df: pd.DataFrame):
     return G
 
 
-def create_bar_chart(df, colname, topic):
-    df_filter = df[df["topics"].apply(lambda s: topic in s)]
-    df_count = df_filter.groupby(colname).count()
+def create_bar_chart(topic_counts, colname, topic):
+    df_filter = topic_counts[topic_counts["topic"] == topic]
+    df_count = df_filter.groupby(colname)["count"].sum().sort_index()
     fig = go.Figure(
-        go.Bar(x=df_count["id"], y=df_count.index, orientation="h")
+        go.Bar(x=df_count.values, y=df_count.index, orientation="h")
     )
     fig.update_layout(
         title="Nombre de textes par catégorie", width=800, height=1000
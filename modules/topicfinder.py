@@ -2,50 +2,432 @@
 This file implements the topic finder to assign words/topics to a document.
 """
 
+import json
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
 import pandas as pd
+from scipy import sparse
+
+# Number of chunks given to each worker, to balance their load
+CHUNKS_PER_JOB = 4
+# Weights of keyword hits in titles and texts in topic scores
+TITLE_WEIGHT = 2.0
+TEXT_WEIGHT = 1.0
+# TopicFinder of a worker process, set once by _init_worker
+_worker_topic_finder = None
+
+
+def _init_worker(topic_finder):
+    """
+    Keeps the topic finder sent to a worker process when it starts.
+    """
+    global _worker_topic_finder
+    _worker_topic_finder = topic_finder
+
+
+def _n_workers(n_jobs: int) -> int:
+    """
+    Number of worker processes of n_jobs, -1 meaning all cores.
+    """
+    if n_jobs == -1:
+        return os.cpu_count()
+    if n_jobs < 1:
+        raise ValueError(f"n_jobs must be -1 or at least 1, not {n_jobs}")
+    return n_jobs
+
+
+def _apply_chunk(method: str, chunk: list) -> list:
+    """
+    Applies a method of the topic finder to a chunk of documents
+    in a worker process.
+    """
+    function = getattr(_worker_topic_finder, method)
+    return [function(text) for text in chunk]
+
+
+def lists_to_matrix(column: pd.Series, vocabulary: list) -> sparse.csr_matrix:
+    """
+    Returns the binary document x vocabulary matrix of a column of lists,
+    such as the words/topics columns of the output dataset.
+    """
+    ids = {value: i for i, value in enumerate(vocabulary)}
+    indptr = [0]
+    indices = []
+    for values in column:
+        indices.extend(sorted({ids[v] for v in values if v in ids}))
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(len(indptr) - 1, len(vocabulary)),
+    )
+
+
+def matrix_to_lists(matrix: sparse.csr_matrix, vocabulary: list) -> list:
+    """
+    Returns, for each row of matrix, the vocabulary of its non zero columns.
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return [
+        [vocabulary[j] for j in matrix.indices[start:end]]
+        for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:])
+    ]
+
+
+def matrix_to_values(matrix: sparse.csr_matrix) -> list:
+    """
+    Returns, for each row of matrix, its non zero values,
+    ordered as the lists of matrix_to_lists.
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return [
+        matrix.data[start:end].tolist()
+        for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:])
+    ]
+
+
+class KeywordIdf:
+    def __init__(
+        self,
+        keywords: list,
+        document_frequency=None,
+        n_documents=0,
+        key: dict = None,
+    ):
+        """
+        Document frequencies of keywords, ordered as keywords.
+        key describes what they were counted on, to tell when to
+        count them again.
+        """
+        self.keywords = keywords
+        self.document_frequency = (
+            np.zeros(len(keywords), dtype=np.int64)
+            if document_frequency is None
+            else np.asarray(document_frequency, dtype=np.int64)
+        )
+        self.n_documents = n_documents
+        self.key = key
+
+    def update(self, keyword_matrix):
+        """
+        Adds the documents of a document x keyword matrix to the counts.
+        """
+        found = sparse.csr_matrix(keyword_matrix) > 0
+        self.document_frequency += np.asarray(found.sum(axis=0)).ravel()
+        self.n_documents += keyword_matrix.shape[0]
+
+    @property
+    def idf(self) -> np.ndarray:
+        """
+        Smoothed inverse document frequency of each keyword.
+        """
+        return (
+            np.log((1 + self.n_documents) / (1 + self.document_frequency))
+            + 1
+        )
+
+    def save(self, path: str):
+        """
+        Saves the document frequencies as json.
+        """
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "key": self.key,
+                    "n_documents": self.n_documents,
+                    "document_frequency": dict(
+                        zip(self.keywords, self.document_frequency.tolist())
+                    ),
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: str, keywords: list):
+        """
+        Loads saved document frequencies, aligned on keywords
+        (keywords added since count as never seen).
+        """
+        with open(path) as f:
+            saved = json.load(f)
+        return cls(
+            keywords,
+            [saved["document_frequency"].get(word, 0) for word in keywords],
+            saved["n_documents"],
+            saved.get("key"),
+        )
+
+
+class KeywordAutomaton:
+    def __init__(self, keywords):
+        """
+        Compiles an Aho-Corasick automaton over the tokens of the keywords,
+        so single-word and multi-word keywords are found in one pass.
+        """
+        # Trie of keyword tokens, state 0 is the root
+        self.goto = [{}]
+        self.outputs = [set()]
+        for keyword in keywords:
+            state = 0
+            for token in keyword.split():
+                if token not in self.goto[state]:
+                    self.goto[state][token] = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append(set())
+                state = self.goto[state][token]
+            if state:
+                self.outputs[state].add(keyword)
+
+        # Failure links, computed breadth first from the root
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(token, 0)
+                self.outputs[next_state] |= self.outputs[self.fail[next_state]]
+
+    def find(self, tokens) -> set:
+        """
+        Returns the distinct keywords found in a sequence of tokens.
+        """
+        found = set()
+        state = 0
+        for token in tokens:
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token, 0)
+            if self.outputs[state]:
+                found |= self.outputs[state]
+        return found
+
+    def count(self, tokens) -> Counter:
+        """
+        Returns the number of occurrences of each keyword found
+        in a sequence of tokens.
+        """
+        counts = Counter()
+        state = 0
+        for token in tokens:
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token, 0)
+            if self.outputs[state]:
+                counts.update(self.outputs[state])
+        return counts
 
 
 class TopicFinder:
-    def __init__(self, topic_word_table: pd.DataFrame):
+    # Worker processes started by workers(), None outside of it
+    _pool = None
+    _pool_size = 1
+
+    def __init__(
+        self, topic_word_table: pd.DataFrame, match_phrases: bool = False
+    ):
         """
         Loads the topic/word table to find topics on.
+        With match_phrases, multi-word keywords are matched as well.
         """
         self.topic_column = topic_word_table["topic"]
         self.words_column = topic_word_table["words"]
+        self.topics = list(self.topic_column)
+        self.match_phrases = match_phrases
+
+        # Inverted index word -> positions of the topics containing it,
+        # built once so each document is tokenized and hashed only once.
+        self.word_index = {}
+        for position, list_words in enumerate(self.words_column):
+            for word in list_words:
+                self.word_index.setdefault(word, set()).add(position)
+
+        self.automaton = (
+            KeywordAutomaton(self.word_index) if match_phrases else None
+        )
 
-    def column_extract_topics(self, find_on: pd.Series) -> pd.DataFrame:
+        # Stable vocabularies: topics in table order, keywords by first
+        # appearance, and the keyword x topic incidence matrix.
+        self.keywords = list(self.word_index)
+        self.keyword_ids = {word: i for i, word in enumerate(self.keywords)}
+        incidence = [
+            (self.keyword_ids[word], position)
+            for word, positions in self.word_index.items()
+            for position in positions
+        ]
+        self.keyword_topic_matrix = sparse.csr_matrix(
+            (
+                np.ones(len(incidence), dtype=np.int32),
+                ([i for i, _ in incidence], [j for _, j in incidence]),
+            ),
+            shape=(len(self.keywords), len(self.topics)),
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_pool", None)
+        state.pop("_pool_size", None)
+        return state
+
+    def _start_pool(self, n_workers: int) -> ProcessPoolExecutor:
+        """
+        Starts n_workers processes, the topic finder being sent once
+        per worker, not once per chunk.
+        """
+        return ProcessPoolExecutor(
+            n_workers, initializer=_init_worker, initargs=(self,)
+        )
+
+    @contextmanager
+    def workers(self, n_jobs: int = -1):
+        """
+        Keeps n_jobs worker processes (-1 for all cores) until exit,
+        used by the column methods asked for more than one job
+        instead of starting processes on every call.
+        """
+        n_workers = _n_workers(n_jobs)
+        if n_workers == 1:
+            yield self
+            return
+        pool = self._start_pool(n_workers)
+        self._pool, self._pool_size = pool, n_workers
+        try:
+            yield self
+        finally:
+            del self._pool, self._pool_size
+            pool.shutdown()
+
+    def _map(self, method: str, find_on: pd.Series, n_jobs: int) -> list:
+        """
+        Applies a method to every document of find_on.
+        With n_jobs > 1 (-1 for all cores), documents are split
+        between as many worker processes, the ones of workers() if
+        started.
+        """
+        n_workers = _n_workers(n_jobs)
+        if n_workers == 1:
+            return list(find_on.map(getattr(self, method)))
+
+        texts = list(find_on)
+        pool = self._pool
+        if pool is not None:
+            n_workers = self._pool_size
+        chunk_size = -(-len(texts) // (n_workers * CHUNKS_PER_JOB)) or 1
+        chunks = [
+            texts[start : start + chunk_size]
+            for start in range(0, len(texts), chunk_size)
+        ]
+        if pool is None:
+            with self._start_pool(n_workers) as pool:
+                found = list(pool.map(partial(_apply_chunk, method), chunks))
+        else:
+            found = pool.map(partial(_apply_chunk, method), chunks)
+        return [result for chunk_found in found for result in chunk_found]
+
+    def column_extract_topics(
+        self, find_on: pd.Series, n_jobs: int = 1
+    ) -> pd.DataFrame:
         """
         Returns distinct words and topics
         from topic_word_table found in column find_on.
         """
+        found = self._map("extract_topics", find_on, n_jobs)
+
         output_dataframe = pd.DataFrame()
         # Creates columns of lists
-        output_dataframe["words"], output_dataframe["topics"] = zip(
-            *find_on.map(self.extract_topics)
-        )
+        output_dataframe["words"], output_dataframe["topics"] = zip(*found)
         return output_dataframe
 
+    def column_keyword_matrix(
+        self, find_on: pd.Series, n_jobs: int = 1
+    ) -> sparse.csr_matrix:
+        """
+        Returns the document x keyword matrix of keyword occurrences
+        in column find_on, columns ordered as self.keywords.
+        """
+        indptr = [0]
+        indices = []
+        data = []
+        for counts in self._map("count_keywords", find_on, n_jobs):
+            indices.extend(self.keyword_ids[word] for word in counts)
+            data.extend(counts.values())
+            indptr.append(len(indices))
+        return sparse.csr_matrix(
+            (np.array(data, dtype=np.int32), indices, indptr),
+            shape=(len(find_on), len(self.keywords)),
+        )
+
+    def topic_matrix(self, keyword_matrix) -> sparse.csr_matrix:
+        """
+        Returns the document x topic matrix of keyword occurrences
+        per topic, columns ordered as self.topics.
+        """
+        return sparse.csr_matrix(keyword_matrix @ self.keyword_topic_matrix)
+
+    def topic_scores(
+        self,
+        title_matrix,
+        text_matrix,
+        title_lengths,
+        text_lengths,
+        idf: KeywordIdf,
+        title_weight: float = TITLE_WEIGHT,
+        text_weight: float = TEXT_WEIGHT,
+    ) -> sparse.csr_matrix:
+        """
+        Returns the document x topic scores: frequencies of the keywords
+        of each topic in titles and texts (occurrences divided by the
+        number of tokens), weighted by their idf and title_weight or
+        text_weight, then summed per topic.
+        """
+        title_tf = sparse.diags(
+            title_weight / np.maximum(np.asarray(title_lengths), 1)
+        )
+        text_tf = sparse.diags(
+            text_weight / np.maximum(np.asarray(text_lengths), 1)
+        )
+        weighted = title_tf @ title_matrix + text_tf @ text_matrix
+        return sparse.csr_matrix(
+            weighted @ sparse.diags(idf.idf) @ self.keyword_topic_matrix
+        )
+
+    def count_keywords(self, input_string: str) -> Counter:
+        """
+        Returns the number of occurrences of each keyword
+        from topic_word_table found in the input string.
+        """
+        if self.match_phrases:
+            return self.automaton.count(input_string.split())
+        return Counter(
+            word for word in input_string.split() if word in self.word_index
+        )
+
     def extract_topics(self, input_string: str) -> tuple:
         """
         Returns distinct words and topics
         from topic_word_table found in the input string.
         """
-        words_found = []
-        topics_found = []
+        # Distinct keywords of any topic found in the document
+        if self.match_phrases:
+            words_found = self.automaton.find(input_string.split())
+        else:
+            words_found = self.word_index.keys() & set(input_string.split())
 
-        # For each topic
-        for topic_name, list_words in zip(
-            self.topic_column, self.words_column
-        ):
-            # Find matches
-            matches = list(
-                {match for match in input_string.split() if match in list_words}
-            )
-            
-            # If there is at least one match, the topic is present
-            if matches != []:
-                topics_found.append(topic_name)
-                words_found += matches
-                
-        # Returns the distinct lists of words and topics
-        return list(set(words_found)), topics_found
+        positions = set()
+        for word in words_found:
+            positions |= self.word_index[word]
+
+        # Topics are returned in the order of topic_word_table
+        topics_found = [self.topics[pos] for pos in sorted(positions)]
+        return list(words_found), topics_found
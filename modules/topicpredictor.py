@@ -0,0 +1,102 @@
+"""
+This file implements the topic predictor to score documents one at a time.
+"""
+
+from collections import Counter
+
+import preprocessing_utils as utils
+from topicfinder import TEXT_WEIGHT, TITLE_WEIGHT
+
+
+class TopicPredictor:
+    def __init__(
+        self,
+        knowledge_base,
+        nlp=None,
+        idf=None,
+        title_weight: float = TITLE_WEIGHT,
+        text_weight: float = TEXT_WEIGHT,
+    ):
+        """
+        Keeps the compiled keyword index of knowledge_base and, for each
+        keyword, the topics it scores with its idf (1 without idf).
+        Documents are lemmatized by the components of nlp used by the
+        batch pipeline, or only normalized without nlp. The components of
+        nlp then make most of the latency of predict: titles are scored
+        well under a millisecond without them (see benchmarks.py point).
+        """
+        self.topic_finder = knowledge_base.topic_finder
+        self.topics = self.topic_finder.topics
+        self.title_weight = title_weight
+        self.text_weight = text_weight
+
+        weights = (
+            idf.idf.tolist()
+            if idf is not None
+            else [1.0] * len(self.topic_finder.keywords)
+        )
+        keyword_ids = self.topic_finder.keyword_ids
+        self.keyword_topics = {
+            word: [(pos, weights[keyword_ids[word]]) for pos in sorted(topics)]
+            for word, topics in self.topic_finder.word_index.items()
+        }
+
+        # Components are called directly, without the overhead of nlp()
+        self.nlp = nlp
+        self.pipeline = (
+            []
+            if nlp is None
+            else [
+                component
+                for name, component in nlp.pipeline
+                if name not in utils.UNUSED_PIPES
+            ]
+        )
+
+    def tokens(self, input_string: str) -> list:
+        """
+        Returns the tokens of a document, preprocessed as preprocess_corpus.
+        """
+        normalized = utils.normalize(input_string)
+        if self.nlp is None:
+            return normalized.split()
+        doc = self.nlp.make_doc(normalized)
+        for component in self.pipeline:
+            doc = component(doc)
+        return " ".join([token.lemma_ for token in doc]).split()
+
+    def count_keywords(self, tokens: list) -> Counter:
+        """
+        Returns the number of occurrences of each keyword in tokens.
+        """
+        if self.topic_finder.match_phrases:
+            return self.topic_finder.automaton.count(tokens)
+        return Counter(word for word in tokens if word in self.keyword_topics)
+
+    def predict(
+        self, title: str, text: str = "", k: int = None, threshold=0.0
+    ) -> list:
+        """
+        Returns the (topic, score) pairs of a document scoring above
+        threshold, best first, keeping at most k of them.
+        Scores are those of TopicFinder.topic_scores.
+        """
+        scores = {}
+        for tokens, weight in [
+            (self.tokens(title), self.title_weight),
+            (self.tokens(text), self.text_weight),
+        ]:
+            if not tokens:
+                continue
+            weight /= len(tokens)
+            for word, count in self.count_keywords(tokens).items():
+                for pos, idf in self.keyword_topics[word]:
+                    scores[pos] = scores.get(pos, 0.0) + count * weight * idf
+
+        # Ties are kept in the order of topic_word_table
+        ranked = sorted(sorted(scores.items()), key=lambda x: -x[1])
+        return [
+            (self.topics[pos], score)
+            for pos, score in ranked[:k]
+            if score > threshold
+        ]